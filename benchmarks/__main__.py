@@ -0,0 +1,26 @@
+"""
+Runs the benchmark suite, or just the named benchmarks, with their default settings.
+
+Usage: python -m benchmarks [storage] [games]
+"""
+import sys
+
+from benchmarks import games, storage
+
+SUITE = {
+    "storage": storage.main,
+    "games": games.main,
+}
+
+
+def main(names):
+    for name in names or SUITE:
+        if name not in SUITE:
+            sys.exit(f"unknown benchmark {name!r}, expected one of: {', '.join(SUITE)}")
+        print(f"== {name} ==")
+        SUITE[name]([])
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,168 @@
+"""
+Monte Carlo return-to-player for the gambling commands.
+
+Simulates millions of rounds of limbo, coinflip and blackjack with NumPy,
+vectorised across rounds, and reports per target / policy:
+
+    rtp      mean payout per unit staked (1.0 is break-even for the player)
+    var      variance of the net result per unit staked
+    p1..p99  percentiles of the net result per unit staked
+
+The game rules mirror dc.py (which can't be imported without starting the
+bot), so keep the constants below in sync when the games change.
+
+Usage: python benchmarks/games.py [--rounds N] [--seed N] [--house-edge E] [--games limbo coinflip blackjack]
+"""
+import argparse
+import time
+
+import numpy as np
+
+# Mirrors LimboEngine in dc.py
+LIMBO_START = 1.11
+LIMBO_CRASH_POINT = 1.4
+LIMBO_OPTIONS = np.round(1.01 + 0.01 * np.arange(10000), 2)
+LIMBO_CUM_WEIGHTS = np.cumsum(1 / LIMBO_OPTIONS)
+LIMBO_TARGETS = (1.2, 1.5, 2.0, 3.0, 5.0, 10.0, 100.0)
+
+# Blackjack as dealt by dc.py: no hole card, the dealer hits below 17
+# (standing on soft 17). Each round is dealt from a freshly shuffled deck,
+# which is close to the bot's 6-deck shoe. Splits and doubles are not
+# simulated. "standard" is what the bot pays; "legacy" is what it credited
+# before wins returned more than the stake.
+BLACKJACK_PAYOUTS = {
+    "legacy": {"win": 1.0, "blackjack": 1.5, "push": 1.0},
+    "standard": {"win": 2.0, "blackjack": 2.5, "push": 1.0},
+}
+BLACKJACK_STAND_ON = (12, 15, 17)
+DEALER_STANDS_ON = 17
+# Ace counts 1 here; hand_total() adds 10 for a usable ace
+CARD_VALUES = np.minimum(np.arange(52) % 13 + 1, 10)
+
+BET = 1000
+BATCH = 250_000
+
+
+def summarize(payouts, bet):
+    """RTP, variance and net-result percentiles for an array of per-round payouts."""
+    net = (payouts - bet) / bet
+    p1, p50, p99 = np.percentile(net, [1, 50, 99])
+    return {"rtp": payouts.mean() / bet, "var": net.var(), "p1": p1, "p50": p50, "p99": p99}
+
+
+def limbo_multipliers(rounds, target, rng, house_edge=None):
+    if house_edge is not None:
+        # LimboEngine's inverse-CDF mode
+        crash = np.floor(100 * (1 - house_edge) / (1 - rng.random(rounds))) / 100
+        return np.maximum(crash, 1.0)
+    multiplier = np.full(rounds, LIMBO_START)
+    active = np.arange(rounds)
+    hi = len(LIMBO_OPTIONS) - 1
+    while active.size:
+        # searchsorted(side="right") is bisect, as in LimboEngine.draw
+        picks = np.searchsorted(LIMBO_CUM_WEIGHTS, rng.random(active.size) * LIMBO_CUM_WEIGHTS[-1], side="right")
+        multiplier[active] *= LIMBO_OPTIONS[np.minimum(picks, hi)]
+        current = multiplier[active]
+        active = active[(current < LIMBO_CRASH_POINT) & (current < target)]
+    return multiplier
+
+
+def simulate_limbo(rounds, target, rng, house_edge=None):
+    payouts = np.empty(rounds)
+    for start in range(0, rounds, BATCH):
+        size = min(BATCH, rounds - start)
+        won = limbo_multipliers(size, target, rng, house_edge) >= target
+        payouts[start:start + size] = np.where(won, int(BET * target), 0)
+    return summarize(payouts, BET)
+
+
+def simulate_coinflip(rounds, rng):
+    heads = rng.integers(0, 2, rounds, dtype=np.int8) == 0
+    return summarize(np.where(heads, 2 * BET, 0).astype(float), BET)
+
+
+def hand_total(hard, has_ace):
+    return np.where(has_ace & (hard + 10 <= 21), hard + 10, hard)
+
+
+def draw_until(cards, position, hard, has_ace, rows, stand_on):
+    """Hit every hand in `rows` until its total reaches stand_on. Updates the arrays in place."""
+    active = rows[hand_total(hard[rows], has_ace[rows]) < stand_on]
+    while active.size:
+        card = cards[active, position[active]]
+        position[active] += 1
+        hard[active] += card
+        has_ace[active] |= card == 1
+        active = active[hand_total(hard[active], has_ace[active]) < stand_on]
+
+
+def simulate_blackjack(rounds, stand_on, payout, rng):
+    payouts = np.empty(rounds)
+    for start in range(0, rounds, BATCH):
+        size = min(BATCH, rounds - start)
+        cards = CARD_VALUES[rng.random((size, 52)).argsort(axis=1)]
+        rows = np.arange(size)
+        position = np.full(size, 3)
+
+        player_hard = cards[:, 0] + cards[:, 1]
+        player_ace = (cards[:, 0] == 1) | (cards[:, 1] == 1)
+        natural = hand_total(player_hard, player_ace) == 21
+        draw_until(cards, position, player_hard, player_ace, rows, stand_on)
+        player = hand_total(player_hard, player_ace)
+
+        dealer_hard = cards[:, 2].copy()
+        dealer_ace = dealer_hard == 1
+        draw_until(cards, position, dealer_hard, dealer_ace, rows[player <= 21], DEALER_STANDS_ON)
+        dealer = hand_total(dealer_hard, dealer_ace)
+
+        win = (player <= 21) & ((dealer > 21) | (dealer < player))
+        push = (player <= 21) & (dealer == player)
+        result = np.zeros(size)
+        result[win] = np.where(natural[win], payout["blackjack"], payout["win"])
+        result[push] = payout["push"]
+        payouts[start:start + size] = result * BET
+    return summarize(payouts, BET)
+
+
+def print_row(label, stats, elapsed):
+    print(
+        f"{label:<28} {stats['rtp']:>8.4f} {stats['var']:>10.4f} "
+        f"{stats['p1']:>8.2f} {stats['p50']:>8.2f} {stats['p99']:>8.2f} {elapsed:>7.2f}s"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--house-edge", type=float, default=None, help="simulate limbo's inverse-CDF mode")
+    parser.add_argument("--games", nargs="+", default=["limbo", "coinflip", "blackjack"])
+    args = parser.parse_args(argv)
+    rng = np.random.default_rng(args.seed)
+
+    runs = []
+    if "limbo" in args.games:
+        runs.extend(
+            (f"limbo {target}x", lambda target=target: simulate_limbo(args.rounds, target, rng, args.house_edge))
+            for target in LIMBO_TARGETS
+        )
+    if "coinflip" in args.games:
+        runs.append(("coinflip", lambda: simulate_coinflip(args.rounds, rng)))
+    if "blackjack" in args.games:
+        runs.extend(
+            (f"blackjack {name} stand {stand_on}",
+             lambda stand_on=stand_on, payout=payout: simulate_blackjack(args.rounds, stand_on, payout, rng))
+            for name, payout in BLACKJACK_PAYOUTS.items()
+            for stand_on in BLACKJACK_STAND_ON
+        )
+
+    print(f"{args.rounds:,} rounds per row, bet {BET}")
+    print(f"{'game':<28} {'rtp':>8} {'var':>10} {'p1':>8} {'p50':>8} {'p99':>8} {'time':>8}")
+    for label, run in runs:
+        start = time.perf_counter()
+        stats = run()
+        print_row(label, stats, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
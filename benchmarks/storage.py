@@ -0,0 +1,156 @@
+"""
+Write throughput of data.db under the compat and performance storage profiles.
+
+Builds a user table shaped like the bot's (1M rows by default), then for each
+profile runs single-row balance updates, one transaction each, the way the
+economy commands write. A second pass repeats the writes while reader threads
+run the leaderboard query in a loop, to show whether readers stall the writer.
+
+Usage: python benchmarks/storage.py [--users N] [--writes N] [--readers N]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from peewee import SqliteDatabase
+from playhouse.pool import PooledSqliteDatabase
+
+# Mirrors STORAGE_PROFILES in dc.py
+PROFILES = {
+    "compat": {
+        "pragmas": {},
+        "pooled": False,
+    },
+    "performance": {
+        "pragmas": {
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "cache_size": -64 * 1024,
+            "mmap_size": 256 * 1024 * 1024,
+            "busy_timeout": 5000,
+            "temp_store": "memory",
+        },
+        "pooled": True,
+        "stale_timeout": 600,
+    },
+}
+
+SCHEMA = """
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" INTEGER NOT NULL, "username" TEXT NOT NULL,
+    "money" INTEGER NOT NULL, "last_daily" DATETIME NOT NULL, "last_weekly" DATETIME NOT NULL,
+    "last_monthly" DATETIME NOT NULL, is_afk BOOLEAN DEFAULT FALSE, afk_message TEXT DEFAULT "",
+    warnings TEXT DEFAULT "[]", lootboxes INTEGER DEFAULT 0, inventory TEXT DEFAULT "[]");
+CREATE UNIQUE INDEX "user_user_id" ON "user" ("user_id");
+"""
+
+FIRST_USER_ID = 10 ** 17
+
+
+def build_database(path, users):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    epoch = "0001-01-01 00:00:00"
+    rows = (
+        (FIRST_USER_ID + i, f"user{i}", random.randrange(1_000_000), epoch, epoch, epoch)
+        for i in range(users)
+    )
+    with conn:
+        conn.executemany(
+            'INSERT INTO "user" (user_id, username, money, last_daily, last_weekly, last_monthly) '
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    conn.close()
+
+
+def open_database(path, profile, threads):
+    settings = PROFILES[profile]
+    if settings["pooled"]:
+        return PooledSqliteDatabase(
+            path,
+            pragmas=settings["pragmas"],
+            max_connections=threads + 1,
+            stale_timeout=settings["stale_timeout"],
+            check_same_thread=False,
+        )
+    return SqliteDatabase(path, pragmas=settings["pragmas"])
+
+
+def run_writes(db, users, writes):
+    ids = [FIRST_USER_ID + random.randrange(users) for _ in range(writes)]
+    start = time.perf_counter()
+    for user_id in ids:
+        with db.atomic():
+            db.execute_sql('UPDATE "user" SET money = money + 1 WHERE user_id = ?', (user_id,))
+    return writes / (time.perf_counter() - start)
+
+
+def run_reader(db, stop, counts):
+    reads = 0
+    while not stop.is_set():
+        try:
+            db.execute_sql('SELECT username, money FROM "user" ORDER BY money DESC LIMIT 5').fetchall()
+            reads += 1
+        except Exception:
+            counts["errors"] += 1
+    counts["reads"] += reads
+    db.close()
+
+
+def bench_profile(template, profile, users, writes, readers):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{profile}-")
+    path = os.path.join(workdir, "data.db")
+    shutil.copy(template, path)
+    db = open_database(path, profile, readers + 1)
+    try:
+        db.connect()
+        solo = run_writes(db, users, writes)
+
+        stop = threading.Event()
+        counts = {"reads": 0, "errors": 0}
+        threads = [threading.Thread(target=run_reader, args=(db, stop, counts)) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        try:
+            contended = run_writes(db, users, writes)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        db.close()
+    finally:
+        if hasattr(db, "close_all"):
+            db.close_all()
+        shutil.rmtree(workdir)
+    return solo, contended, counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--writes", type=int, default=5_000)
+    parser.add_argument("--readers", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench-template-")
+    template = os.path.join(workdir, "data.db")
+    try:
+        start = time.perf_counter()
+        build_database(template, args.users)
+        print(f"built {args.users:,} users in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'profile':<12} {'writes/s':>10} {'writes/s w/ readers':>20} {'reads':>8} {'errors':>7}")
+        for profile in PROFILES:
+            solo, contended, counts = bench_profile(template, profile, args.users, args.writes, args.readers)
+            print(f"{profile:<12} {solo:>10,.0f} {contended:>20,.0f} {counts['reads']:>8,} {counts['errors']:>7,}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,65 @@
 import asyncio
 import json
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 import discord
 from discord.ext import commands, tasks
 import random
+from bisect import bisect
 from datetime import datetime, timedelta
 from discord.ui import Button, View
 import datetime
-from peewee import SqliteDatabase, Model, IntegerField, TextField, DateTimeField, OperationalError, BooleanField
+from peewee import SqliteDatabase, Model, IntegerField, TextField, DateTimeField, BooleanField, Tuple, fn, EXCLUDED
 import os
 import aiohttp
+from urllib.parse import urlsplit
 from googletrans import Translator
-import requests
-from playhouse.shortcuts import model_to_dict
+from playhouse.pool import PooledSqliteDatabase
+
+# Storage profiles for data.db. "compat" is SQLite's stock rollback journal with
+# a single connection; "performance" switches to WAL so leaderboard reads don't
+# block writers, relaxes fsyncs to once per checkpoint and pools connections for
+# the database executor threads.
+STORAGE_PROFILES = {
+    "compat": {
+        "pragmas": {},
+        "pooled": False,
+    },
+    "performance": {
+        "pragmas": {
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "cache_size": -64 * 1024,  # 64 MiB
+            "mmap_size": 256 * 1024 * 1024,
+            "busy_timeout": 5000,
+            "temp_store": "memory",
+        },
+        "pooled": True,
+        "stale_timeout": 600,
+    },
+}
+STORAGE_PROFILE = "performance"
+DB_READ_WORKERS = 4
+
+def open_database(path, profile):
+    settings = STORAGE_PROFILES[profile]
+    if settings["pooled"]:
+        # One connection per executor thread plus the main thread
+        return PooledSqliteDatabase(
+            path,
+            pragmas=settings["pragmas"],
+            max_connections=DB_READ_WORKERS + 2,
+            stale_timeout=settings["stale_timeout"],
+            # Pooled connections may be returned by one thread and reused by another
+            check_same_thread=False,
+        )
+    return SqliteDatabase(path, pragmas=settings["pragmas"])
 
-db = SqliteDatabase('data.db')
+db = open_database('data.db', STORAGE_PROFILE)
 
 class BaseModel(Model):
     class Meta:
@@ -31,78 +74,831 @@ class User(BaseModel):
     last_monthly = DateTimeField(default=datetime.datetime(datetime.MINYEAR, 1, 1))
     is_afk = BooleanField(default=False)
     afk_message = TextField(default='')
-    warnings = TextField(default='[]') 
     lootboxes = IntegerField(default=0)
-    inventory = TextField(default='[]')
+
+    class Meta:
+        indexes = (
+            (('money', 'user_id'), False),
+        )
 
 class Prefix(BaseModel):
     guild_id = IntegerField(unique=True)
     prefix = TextField()
 
-db.connect()
-with db.atomic():
-    db.create_tables([User, Prefix], safe=True)
+# Warnings imported from warns.json predate per-guild scoping and are shown in every guild
+LEGACY_WARN_GUILD_ID = 0
 
-try:
-    with db.atomic():
-        db.execute_sql('ALTER TABLE user ADD COLUMN last_monthly DATETIME DEFAULT "0001-01-01 00:00:00"')
-except OperationalError:
-    pass
+class Warn(BaseModel):
+    guild_id = IntegerField()
+    user_id = IntegerField()
+    moderator_id = IntegerField(null=True)
+    reason = TextField()
+    created_at = DateTimeField(default=datetime.datetime.now)
 
-with db.atomic():
-    try:
-        db.execute_sql('ALTER TABLE user ADD COLUMN is_afk BOOLEAN DEFAULT FALSE')
-        db.execute_sql('ALTER TABLE user ADD COLUMN afk_message TEXT DEFAULT ""')
-        db.execute_sql('ALTER TABLE user ADD COLUMN warnings TEXT DEFAULT "[]"')
-        db.execute_sql('ALTER TABLE user ADD COLUMN inventory TEXT DEFAULT "[]"')
-    except OperationalError:
-        pass
+    class Meta:
+        table_name = 'warning'
+        indexes = (
+            (('guild_id', 'user_id'), False),
+        )
 
-with db.atomic():
-    try:
-        db.execute_sql('ALTER TABLE user ADD COLUMN lootboxes INTEGER DEFAULT 0')
-    except OperationalError:
-        pass
+class InventoryItem(BaseModel):
+    user_id = IntegerField()
+    item_id = IntegerField()
+    quantity = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'inventory'
+        indexes = (
+            (('user_id', 'item_id'), True),
+        )
+
+class BlackjackSession(BaseModel):
+    # Stakes of games in progress, refunded if the bot restarts mid-game
+    user_id = IntegerField(unique=True)
+    bet = IntegerField()
+    created_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'blackjack_session'
+
+class SchemaMigration(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'schema_migration'
+
+def add_column(table, column, definition):
+    # Databases from before the migration table may already have the column
+    if column not in [c.name for c in db.get_columns(table)]:
+        db.execute_sql(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
-with db.atomic():
+def load_legacy_warnings():
     try:
-        db.execute_sql('ALTER TABLE user ADD COLUMN inventory TEXT DEFAULT "[]"')
-    except OperationalError:
-        pass
+        with open('warns.json', 'r', encoding='utf-8') as f:
+            return json.load(f).get('users', [])
+    except (FileNotFoundError, ValueError):
+        return []
+
+def migrate_initial_tables():
+    db.create_tables([User, Prefix], safe=True)
+
+def migrate_last_monthly():
+    add_column('user', 'last_monthly', 'DATETIME DEFAULT "0001-01-01 00:00:00"')
+
+def migrate_afk_and_legacy_lists():
+    add_column('user', 'is_afk', 'BOOLEAN DEFAULT FALSE')
+    add_column('user', 'afk_message', 'TEXT DEFAULT ""')
+    add_column('user', 'warnings', 'TEXT DEFAULT "[]"')
+    add_column('user', 'inventory', 'TEXT DEFAULT "[]"')
+
+def migrate_lootboxes():
+    add_column('user', 'lootboxes', 'INTEGER DEFAULT 0')
+
+def migrate_inventory_table():
+    # Move inventories out of the old JSON list column into their own table
+    if InventoryItem.table_exists():
+        return
+    db.create_tables([InventoryItem])
+    rows = []
+    for user_id, inventory in db.execute_sql("SELECT user_id, inventory FROM user WHERE inventory != '[]'"):
+        item_counts = {}
+        for item_id in json.loads(inventory):
+            item_counts[item_id] = item_counts.get(item_id, 0) + 1
+        rows.extend(
+            {'user_id': user_id, 'item_id': item_id, 'quantity': quantity}
+            for item_id, quantity in item_counts.items()
+        )
+    for i in range(0, len(rows), 500):
+        InventoryItem.insert_many(rows[i:i + 500]).execute()
+    db.execute_sql("UPDATE user SET inventory = '[]'")
 
-if not Prefix.table_exists():
-    # If not, create it
+def migrate_warning_table():
+    # One-time import of warns.json and the unused User.warnings column
+    if Warn.table_exists():
+        return
+    db.create_tables([Warn])
+    now = datetime.datetime.now()
+    rows = []
+    for entry in load_legacy_warnings():
+        rows.extend(
+            {'guild_id': LEGACY_WARN_GUILD_ID, 'user_id': entry['id'], 'reason': reason, 'created_at': now}
+            for reason in entry['reasons']
+        )
+    for user_id, warnings in db.execute_sql("SELECT user_id, warnings FROM user WHERE warnings != '[]'"):
+        rows.extend(
+            {'guild_id': LEGACY_WARN_GUILD_ID, 'user_id': user_id, 'reason': str(reason), 'created_at': now}
+            for reason in json.loads(warnings)
+        )
+    for i in range(0, len(rows), 500):
+        Warn.insert_many(rows[i:i + 500]).execute()
+    db.execute_sql("UPDATE user SET warnings = '[]'")
+
+def migrate_user_indexes():
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "user_money_user_id" ON "user" ("money", "user_id")')
+    # Only a handful of users are AFK at a time, so index just those rows
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "user_is_afk" ON "user" ("is_afk") WHERE "is_afk" = 1')
+
+def migrate_blackjack_sessions():
+    db.create_tables([BlackjackSession])
+
+# Append only; a migration's version must never change once it has shipped
+MIGRATIONS = [
+    (1, 'initial tables', migrate_initial_tables),
+    (2, 'user.last_monthly', migrate_last_monthly),
+    (3, 'user afk and legacy list columns', migrate_afk_and_legacy_lists),
+    (4, 'user.lootboxes', migrate_lootboxes),
+    (5, 'inventory table', migrate_inventory_table),
+    (6, 'warning table', migrate_warning_table),
+    (7, 'user money and afk indexes', migrate_user_indexes),
+    (8, 'blackjack session table', migrate_blackjack_sessions),
+]
+
+def run_migrations():
+    """Apply every pending migration in one transaction. Returns the versions applied."""
+    db.create_tables([SchemaMigration], safe=True)
+    current = SchemaMigration.select(fn.MAX(SchemaMigration.version)).scalar() or 0
+    pending = [migration for migration in MIGRATIONS if migration[0] > current]
+    if not pending:
+        return []
     with db.atomic():
-        db.create_table(Prefix)
+        for version, name, migration in pending:
+            migration()
+            SchemaMigration.create(version=version, name=name)
+    for version, name, _ in pending:
+        print(f'Applied migration {version}: {name}')
+    return [version for version, _, _ in pending]
+
+db.connect()
+run_migrations()
+
+class DatabaseExecutor:
+    """
+    Runs peewee calls off the event loop. Writes are serialised on a single
+    thread so SQLite never has competing writers; reads share a small pool.
+    Each thread gets its own connection from peewee.
+    """
+
+    def __init__(self, read_workers=4):
+        self.pools = {
+            'read': ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-read'),
+            'write': ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write'),
+        }
+        self.stats = {
+            kind: {'pending': 0, 'calls': 0, 'errors': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'run_total': 0.0}
+            for kind in self.pools
+        }
+
+    async def read(self, func, *args, **kwargs):
+        return await self.submit('read', func, *args, **kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        return await self.submit('write', func, *args, **kwargs)
+
+    async def submit(self, kind, func, *args, **kwargs):
+        stats = self.stats[kind]
+        started = []
 
-def get_prefix(bot, message):
+        def job():
+            started.append(time.perf_counter())
+            return func(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        stats['pending'] += 1
+        queued = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.pools[kind], job)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            finished = time.perf_counter()
+            stats['pending'] -= 1
+            stats['calls'] += 1
+            if started:
+                wait = started[0] - queued
+                stats['wait_total'] += wait
+                stats['wait_max'] = max(stats['wait_max'], wait)
+                stats['run_total'] += finished - started[0]
+
+    def shutdown(self):
+        # Drain the readers first, then let the writer finish anything still queued
+        for kind in ('read', 'write'):
+            self.pools[kind].shutdown(wait=True)
+
+db_executor = DatabaseExecutor(read_workers=DB_READ_WORKERS)
+
+DEFAULT_PREFIX = ","
+
+# guild_id -> prefix. Guilds without a custom prefix are cached as DEFAULT_PREFIX
+# so a miss only ever costs one query per guild.
+prefix_cache = {}
+
+def load_prefix_cache():
+    prefix_cache.clear()
+    for guild_id, prefix in Prefix.select(Prefix.guild_id, Prefix.prefix).tuples():
+        prefix_cache[guild_id] = prefix
+
+def fetch_guild_prefix(guild_id):
     try:
-        prefix = Prefix.get(Prefix.guild_id == message.guild.id).prefix
+        return Prefix.get(Prefix.guild_id == guild_id).prefix
     except Prefix.DoesNotExist:
-        prefix = ","  # Default prefix
+        return DEFAULT_PREFIX
+
+def store_guild_prefix(guild_id, new_prefix):
+    Prefix.insert(guild_id=guild_id, prefix=new_prefix).on_conflict(
+        conflict_target=[Prefix.guild_id],
+        update={Prefix.prefix: new_prefix}
+    ).execute()
+
+async def get_guild_prefix(guild_id):
+    try:
+        return prefix_cache[guild_id]
+    except KeyError:
+        pass
+    prefix = await db_executor.read(fetch_guild_prefix, guild_id)
+    prefix_cache[guild_id] = prefix
     return prefix
 
+async def set_guild_prefix(guild_id, new_prefix):
+    await db_executor.write(store_guild_prefix, guild_id, new_prefix)
+    prefix_cache[guild_id] = new_prefix
+
+async def get_prefix(bot, message):
+    if message.guild is None:
+        return DEFAULT_PREFIX
+    return await get_guild_prefix(message.guild.id)
+
+load_prefix_cache()
+
+# user_id -> afk message for every user currently marked AFK. Only a handful of
+# users are ever AFK, so on_message checks this instead of querying the DB.
+afk_users = {}
+
+def load_afk_users():
+    afk_users.clear()
+    query = User.select(User.user_id, User.afk_message).where(User.is_afk == True)
+    for user_id, afk_message in query.tuples():
+        afk_users[user_id] = afk_message
+
+def store_afk(user_id, username, message):
+    User.insert(user_id=user_id, username=username, is_afk=True, afk_message=message).on_conflict(
+        conflict_target=[User.user_id],
+        update={User.is_afk: True, User.afk_message: message}
+    ).execute()
+    note_user_change(user_id)
+
+def remove_afk(user_id):
+    User.update(is_afk=False, afk_message='').where(User.user_id == user_id).execute()
+    note_user_change(user_id)
+
+# The registry is updated before the write is queued; the single writer thread
+# keeps the DB in the same order.
+async def set_afk(user_id, username, message):
+    afk_users[user_id] = message
+    await db_executor.write(store_afk, user_id, username, message)
+
+async def clear_afk(user_id):
+    """Clear a user's AFK status. Returns False if they weren't AFK."""
+    if afk_users.pop(user_id, None) is None:
+        return False
+    await db_executor.write(remove_afk, user_id)
+    return True
+
+load_afk_users()
+
 def get_or_create_user(user_id, username):
     user, created = User.get_or_create(user_id=user_id, defaults={'username': username})
     if created:
-        user.save()
+        note_user_change(user_id)
     return user
 
-with open('loot_items.json', 'r') as f:
-    loot_items = json.load(f)
+def note_user_change(user_id, balance=None):
+    """Tell the caches a user's row changed. Pass the new balance when it's known."""
+    user_exporter.mark(user_id)
+    if balance is not None:
+        top_users.note_balance(user_id, balance)
+
+async def load_user(user_id, username):
+    """Load a user off the event loop, creating the row on the writer if needed."""
+    user = await db_executor.read(User.get_or_none, User.user_id == user_id)
+    if user is None:
+        user = await db_executor.write(get_or_create_user, user_id, username)
+    return user
+
+# Write-behind for bets. When enabled, bets are checked against the stored
+# balance plus pending deltas and only accumulated in memory, then flushed in one
+# transaction every flush_interval_ms or max_pending_ops bets, whichever is
+# first. Anything not yet flushed is lost if the process dies, so the interval is
+# the durability window.
+WRITE_BEHIND = {
+    "enabled": False,
+    "flush_interval_ms": 500,
+    "max_pending_ops": 200,
+}
+
+class BalanceBuffer:
+    """
+    Pending balance deltas per user. Bets and flushes run on the database writer;
+    the lock keeps balance reads from the read pool consistent with a flush in
+    progress.
+    """
+
+    def __init__(self, enabled, flush_interval_ms, max_pending_ops):
+        self.enabled = enabled
+        self.flush_interval_ms = flush_interval_ms
+        self.max_pending_ops = max_pending_ops
+        self.deltas = {}
+        self.ops = 0
+        self.lock = threading.RLock()
+
+    def balance(self, user_id):
+        with self.lock:
+            money = User.select(User.money).where(User.user_id == user_id).scalar()
+            if money is None:
+                return None
+            return money + self.deltas.get(user_id, 0)
+
+    def settle_bet(self, user_id, stake, payout):
+        with self.lock:
+            balance = self.balance(user_id)
+            if balance is None or balance < stake:
+                return None
+            delta = payout - stake
+            self.deltas[user_id] = self.deltas.get(user_id, 0) + delta
+            note_user_change(user_id, balance + delta)
+            self.ops += 1
+            if self.ops >= self.max_pending_ops:
+                self.flush()
+            return balance + delta
+
+    def apply_pending(self, user_id):
+        """Write one user's pending delta so a direct balance write sees it."""
+        with self.lock:
+            delta = self.deltas.pop(user_id, 0)
+            if delta:
+                User.update(money=User.money + delta).where(User.user_id == user_id).execute()
+                note_user_change(user_id)
+                top_users.invalidate()
+
+    def discard(self, user_id):
+        with self.lock:
+            self.deltas.pop(user_id, None)
+
+    def flush(self):
+        with self.lock:
+            if self.deltas:
+                with db.atomic():
+                    for user_id, delta in self.deltas.items():
+                        if delta:
+                            User.update(money=User.money + delta).where(User.user_id == user_id).execute()
+                            note_user_change(user_id)
+                top_users.invalidate()
+            flushed = len(self.deltas)
+            self.deltas = {}
+            self.ops = 0
+            return flushed
+
+balance_buffer = BalanceBuffer(**WRITE_BEHIND)
+
+LEADERBOARD_SIZE = 5
+
+class TopUsersCache:
+    """
+    The leaderboard's top rows, served from memory until a balance write could
+    change them. Writes report the new balance from the database writer; the
+    version counter stops a fetch that raced with a write from caching stale rows.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rows = None
+        self.version = 0
+
+    def invalidate(self):
+        self.version += 1
+        self.rows = None
+
+    def note_balance(self, user_id, balance):
+        rows = self.rows
+        # With nothing cached a fetch may be in flight, so the version still has to move
+        if rows is None or len(rows) < self.size or balance >= rows[-1][2] or any(row[0] == user_id for row in rows):
+            self.invalidate()
+
+    async def get(self):
+        rows = self.rows
+        if rows is None:
+            version = self.version
+            rows = await db_executor.read(fetch_leaderboard_page, self.size)
+            if version == self.version:
+                self.rows = rows
+        return rows
+
+# Leaderboards are ordered by (money, user_id) descending and paged with keyset
+# cursors on that pair, so every page is a range scan of the (money, user_id)
+# index no matter how deep it is.
+
+# Stay under SQLite's bound parameter limit when filtering by guild members
+MAX_QUERY_IDS = 30000
+
+def leaderboard_query(limit, after=None, user_ids=None):
+    query = User.select(User.user_id, User.username, User.money)
+    if after is not None:
+        query = query.where(Tuple(User.money, User.user_id) < Tuple(*after))
+    if user_ids is not None:
+        query = query.where(User.user_id.in_(user_ids))
+    return query.order_by(User.money.desc(), User.user_id.desc()).limit(limit)
+
+def fetch_leaderboard_page(limit, after=None, user_ids=None):
+    """
+    Up to `limit` (user_id, username, money) rows following the (money, user_id)
+    cursor `after`, optionally restricted to `user_ids`.
+    """
+    if user_ids is None:
+        return list(leaderboard_query(limit, after).tuples())
+    rows = []
+    for i in range(0, len(user_ids), MAX_QUERY_IDS):
+        rows.extend(leaderboard_query(limit, after, user_ids[i:i + MAX_QUERY_IDS]).tuples())
+    rows.sort(key=lambda row: (row[2], row[0]), reverse=True)
+    return rows[:limit]
+
+def fetch_rank(user_id, user_ids=None):
+    """
+    (money, rank) for a user, counting the users ahead of them in the index
+    rather than sorting. Returns None if they have no row.
+    """
+    money = User.select(User.money).where(User.user_id == user_id).scalar()
+    if money is None:
+        return None
+    ahead = Tuple(User.money, User.user_id) > Tuple(money, user_id)
+    if user_ids is None:
+        return money, User.select(fn.COUNT(User.user_id)).where(ahead).scalar() + 1
+    count = 0
+    for i in range(0, len(user_ids), MAX_QUERY_IDS):
+        chunk = user_ids[i:i + MAX_QUERY_IDS]
+        count += User.select(fn.COUNT(User.user_id)).where(ahead & User.user_id.in_(chunk)).scalar()
+    return money, count + 1
+
+# One extra row tells the first page whether there is a next one
+top_users = TopUsersCache(LEADERBOARD_SIZE + 1)
+
+# Balance changes are single conditional UPDATEs so concurrent commands from the
+# same user can't lose updates or overdraw. These run on the database writer.
+
+def fetch_balance(user_id):
+    """A user's balance including unflushed bets, or None if they have no row."""
+    if balance_buffer.enabled:
+        return balance_buffer.balance(user_id)
+    return User.select(User.money).where(User.user_id == user_id).scalar()
+
+def change_balance(user_id, delta, minimum=None):
+    """
+    Add delta to a user's balance, only if their balance is at least `minimum`.
+    Returns the new balance, or None if the user doesn't exist or can't cover it.
+    """
+    if balance_buffer.enabled:
+        balance_buffer.apply_pending(user_id)
+    query = User.update(money=User.money + delta).where(User.user_id == user_id)
+    if minimum is not None:
+        query = query.where(User.money >= minimum)
+    for (balance,) in query.returning(User.money).tuples().execute():
+        note_user_change(user_id, balance)
+        return balance
+    return None
+
+def settle_bet(user_id, stake, payout):
+    """Take a stake and pay out its winnings in one statement. Returns the new balance or None."""
+    if balance_buffer.enabled:
+        return balance_buffer.settle_bet(user_id, stake, payout)
+    return change_balance(user_id, payout - stake, minimum=stake)
+
+def set_balance(user_id, username, amount):
+    if balance_buffer.enabled:
+        balance_buffer.discard(user_id)
+    User.insert(user_id=user_id, username=username, money=amount).on_conflict(
+        conflict_target=[User.user_id],
+        update={User.money: amount}
+    ).execute()
+    note_user_change(user_id, amount)
+
+def transfer_money(sender_id, receiver_id, receiver_name, amount):
+    """Move money between two users in one transaction. Returns the sender's new balance or None."""
+    with db.atomic():
+        balance = change_balance(sender_id, -amount, minimum=amount)
+        if balance is None:
+            return None
+        query = User.insert(user_id=receiver_id, username=receiver_name, money=amount).on_conflict(
+            conflict_target=[User.user_id],
+            update={User.money: User.money + amount}
+        ).returning(User.money)
+        receiver_balance = query.tuples().execute()[0][0]
+    # Report again now the transaction has committed
+    note_user_change(sender_id, balance)
+    note_user_change(receiver_id, receiver_balance)
+    return balance
+
+def add_inventory_item(user_id, item_id, quantity=1):
+    InventoryItem.insert(user_id=user_id, item_id=item_id, quantity=quantity).on_conflict(
+        conflict_target=[InventoryItem.user_id, InventoryItem.item_id],
+        update={InventoryItem.quantity: InventoryItem.quantity + quantity}
+    ).execute()
+
+def fetch_inventory(user_id):
+    """A user's (item_id, quantity) pairs, ordered by item id."""
+    query = (InventoryItem
+             .select(InventoryItem.item_id, InventoryItem.quantity)
+             .where((InventoryItem.user_id == user_id) & (InventoryItem.quantity > 0))
+             .order_by(InventoryItem.item_id))
+    return list(query.tuples())
+
+def purchase_item(user_id, item_id, price):
+    """Charge a user for an item and add it to their inventory. Returns the new balance or None."""
+    with db.atomic():
+        balance = change_balance(user_id, -price, minimum=price)
+        if balance is None:
+            return None
+        add_inventory_item(user_id, item_id)
+    note_user_change(user_id, balance)
+    return balance
 
-with open('shop_items.json', 'r') as f:
-    loot_items = json.load(f)
+LOOTBOX_BULK_MAX = 10000
+
+def open_lootboxes(user_id, count, draw):
+    """
+    Use up `count` of a user's lootboxes (all of them, up to LOOTBOX_BULK_MAX, if None)
+    and award draw(opened) -> {item_id: quantity} in one transaction.
+    Returns (opened, drops, lootboxes left), or None if the user doesn't have enough.
+    """
+    with db.atomic():
+        lootboxes = User.select(User.lootboxes).where(User.user_id == user_id).scalar() or 0
+        opened = min(lootboxes, LOOTBOX_BULK_MAX) if count is None else count
+        if opened <= 0 or lootboxes < opened:
+            return None
+        User.update(lootboxes=User.lootboxes - opened).where(User.user_id == user_id).execute()
+        drops = draw(opened)
+        rows = [{'user_id': user_id, 'item_id': item_id, 'quantity': quantity} for item_id, quantity in drops.items()]
+        InventoryItem.insert_many(rows).on_conflict(
+            conflict_target=[InventoryItem.user_id, InventoryItem.item_id],
+            update={InventoryItem.quantity: InventoryItem.quantity + EXCLUDED.quantity}
+        ).execute()
+    note_user_change(user_id)
+    return opened, drops, lootboxes - opened
+
+# Reward amounts and cooldowns for ,daily ,weekly and ,monthly. Each claim is
+# stamped in the user's last_<name> column.
+REWARDS = {
+    "daily": {"money": 500, "lootboxes": 1, "cooldown": datetime.timedelta(days=1)},
+    "weekly": {"money": 5000, "lootboxes": 3, "cooldown": datetime.timedelta(days=7)},
+    "monthly": {"money": 100000, "lootboxes": 5, "cooldown": datetime.timedelta(days=30)},
+}
+
+def claim_reward(user_id, username, name):
+    """
+    Grant a reward if its cooldown has passed, checked and applied in one upsert.
+    Returns (new balance, None) on success or (None, time remaining) on cooldown.
+    """
+    reward = REWARDS[name]
+    last_claim = getattr(User, f'last_{name}')
+    now = datetime.datetime.now()
+    if balance_buffer.enabled:
+        balance_buffer.apply_pending(user_id)
+    query = User.insert(
+        user_id=user_id, username=username, money=reward["money"],
+        lootboxes=reward["lootboxes"], **{last_claim.name: now}
+    ).on_conflict(
+        conflict_target=[User.user_id],
+        update={
+            User.money: User.money + reward["money"],
+            User.lootboxes: User.lootboxes + reward["lootboxes"],
+            last_claim: now,
+        },
+        where=(last_claim <= now - reward["cooldown"])
+    ).returning(User.money)
+    for (balance,) in query.tuples().execute():
+        note_user_change(user_id, balance)
+        return balance, None
+    claimed_at = User.select(last_claim).where(User.user_id == user_id).scalar()
+    return None, claimed_at + reward["cooldown"] - now
+
+# Drop odds per rarity, in percent. Items of the same rarity share its odds equally.
+RARITY_WEIGHTS = {
+    "common": 50,
+    "uncommon": 28,
+    "rare": 14,
+    "epic": 6,
+    "legendary": 1.5,
+    "demise": 0.25,
+    "retro": 0.25,
+}
+
+class AliasSampler:
+    """Walker's alias method: O(n) setup, then O(1) weighted draws."""
+
+    def __init__(self, values, weights):
+        total = sum(weights)
+        if not values or total <= 0:
+            raise ValueError("AliasSampler needs at least one positive weight")
+        n = len(values)
+        self.values = list(values)
+        self.probability = [0.0] * n
+        self.alias = list(range(n))
+        scaled = [weight * n / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1 up to rounding error
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def draw(self):
+        column = random.randrange(len(self.values))
+        if random.random() < self.probability[column]:
+            return self.values[column]
+        return self.values[self.alias[column]]
+
+class ItemCatalog:
+    """
+    An item table loaded from a JSON list, indexed by item_id and rarity. The
+    file is reloaded by refresh() whenever its mtime changes; a file that fails
+    validation is reported and the previous table is kept. Every item_id must
+    fall in `id_range`, so tables sharing the inventory can't collide.
+    """
+
+    fields = {'item_id': int, 'name': str, 'price': int, 'rarity': str}
+
+    def __init__(self, path, id_range, extra_fields=None, rarity_weights=None):
+        self.path = path
+        self.id_range = id_range
+        self.fields = {**self.fields, **(extra_fields or {})}
+        self.rarity_weights = rarity_weights
+        self.items = []
+        self.by_id = {}
+        self.by_rarity = {}
+        self.sampler = None
+        self.mtime = None
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+        if not isinstance(items, list):
+            raise ValueError(f"{self.path}: expected a list of items")
+        by_id = {}
+        by_rarity = {}
+        for index, item in enumerate(items):
+            for field, kind in self.fields.items():
+                if not isinstance(item.get(field), kind):
+                    raise ValueError(f"{self.path}: item {index} needs a {kind.__name__} '{field}'")
+            if item['item_id'] in by_id:
+                raise ValueError(f"{self.path}: duplicate item_id {item['item_id']}")
+            if item['item_id'] not in self.id_range:
+                raise ValueError(
+                    f"{self.path}: item_id {item['item_id']} is outside "
+                    f"{self.id_range.start}-{self.id_range.stop - 1}"
+                )
+            if item['price'] < 0:
+                raise ValueError(f"{self.path}: item {item['item_id']} has a negative price")
+            by_id[item['item_id']] = item
+            by_rarity.setdefault(item['rarity'], []).append(item)
+        sampler = None
+        if self.rarity_weights is not None:
+            for rarity in by_rarity:
+                if rarity not in self.rarity_weights:
+                    raise ValueError(f"{self.path}: no drop weight for rarity '{rarity}'")
+            sampler = AliasSampler(items, [
+                self.rarity_weights[item['rarity']] / len(by_rarity[item['rarity']]) for item in items
+            ])
+        self.items, self.by_id, self.by_rarity, self.sampler, self.mtime = items, by_id, by_rarity, sampler, mtime
+
+    def refresh(self):
+        """Reload the file if it changed since the last load. Returns True if it was reloaded."""
+        try:
+            if os.stat(self.path).st_mtime == self.mtime:
+                return False
+            self.load()
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Keeping the previous {self.path}: {e}")
+            return False
+
+    def get(self, item_id):
+        return self.by_id.get(item_id)
+
+    def draw_many(self, count):
+        """Draw `count` items by rarity weight. Returns {item_id: quantity}."""
+        sampler = self.sampler
+        drops = {}
+        for _ in range(count):
+            item_id = sampler.draw()['item_id']
+            drops[item_id] = drops.get(item_id, 0) + 1
+        return drops
+
+# Inventory rows only store the item_id, so each table owns its own id range
+SHOP_ITEM_IDS = range(1, 1000)
+LOOT_ITEM_IDS = range(1001, 2000)
+
+shop_items = ItemCatalog('shop_items.json', SHOP_ITEM_IDS, {'emoji': str})
+shop_items.load()
+loot_items = ItemCatalog('loot_items.json', LOOT_ITEM_IDS, rarity_weights=RARITY_WEIGHTS)
+loot_items.load()
+item_catalogs = (shop_items, loot_items)
+for i, catalog in enumerate(item_catalogs):
+    for other in item_catalogs[i + 1:]:
+        if catalog.id_range.start < other.id_range.stop and other.id_range.start < catalog.id_range.stop:
+            raise ValueError(f"{catalog.path} and {other.path} have overlapping id ranges")
+
+def find_item(item_id):
+    """Look up an inventory item in the table that owns its id."""
+    for catalog in item_catalogs:
+        if item_id in catalog.id_range:
+            return catalog.get(item_id)
+    return None
+
+def item_label(item):
+    # Loot table items have no emoji
+    if 'emoji' in item:
+        return f"{item['emoji']} {item['name']}"
+    return item['name']
+
+class HttpClient:
+    """
+    One aiohttp session for every outbound request the bot makes, so
+    connections, TLS sessions and DNS lookups are reused between commands.
+    The session is created on first use, inside the running event loop, and
+    closed when the bot shuts down. Latency is recorded per upstream host.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, dns_ttl=300, connect_timeout=5, read_timeout=10):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+        # host -> {'requests', 'errors', 'total', 'max'}, times in seconds
+        self.stats = {}
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def get_json(self, url, **kwargs):
+        """GET a URL and decode its JSON body. Raises one of HTTP_ERRORS on failure."""
+        host = urlsplit(url).hostname
+        stats = self.stats.setdefault(host, {'requests': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+        started = time.perf_counter()
+        try:
+            async with self.session().get(url, **kwargs) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats['requests'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+# What HttpClient.get_json raises for network errors, timeouts, bad statuses and bad JSON
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+http_client = HttpClient()
+
+class RetroBot(commands.Bot):
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            await http_client.close()
 
 intents = discord.Intents.all()
 intents.message_content = True
-bot = commands.Bot(command_prefix=get_prefix,intents=intents,help_command=None)
+bot = RetroBot(command_prefix=get_prefix,intents=intents,help_command=None)
 
 COMMAND_CATEGORIES = {
     "⚡ Utility": ["cmd", "shia", "uptime", "info", "eth", "btc", "ltc", "lock", "unlock", "slowmode", "ping", "serverinfo"],
     "🔨 Moderation": ["role", "mute", "unmute", "kick", "ban", "unban", "purge", "warn", "warns", "nick", "prefix", "setprefix"],
     "🎉 Fun": ["limbo", "coinflip", "dick", "gay", "_8ball", "cat", "dog"],
-    "👛 Economy": ["daily", "weekly", "monthly", "give", "money", "leaderboard", "lootbox", "lb", "shop", "buy", "inv"],
+    "👛 Economy": ["daily", "weekly", "monthly", "give", "money", "leaderboard", "rank", "lootbox", "lb", "shop", "buy", "inv"],
     "✨ Extras": ["afk", "afkoff", "remindme", "weather", "cuddle", "meme","credits"],
 }
 CATEGORY_DESCRIPTIONS = {
@@ -309,6 +1105,11 @@ async def on_guild_join(guild):
             except discord.Forbidden:
                 print(f"Could not send DM to {inviter.name}")
 
+@bot.event
+async def on_guild_remove(guild):
+    # Keep the stored prefix for a re-invite, but don't hold the entry in memory
+    prefix_cache.pop(guild.id, None)
+
 def format_timedelta(td):
     days = td.days
     hours, remainder = divmod(td.seconds, 3600)
@@ -336,13 +1137,8 @@ async def setprefix(ctx, new_prefix: str):
         return
     
     try:
-        # Ensure there's a default prefix in the database
-        prefix, created = Prefix.get_or_create(guild_id=ctx.guild.id, defaults={'prefix': ','})
-        
-        # Update to the new prefix
-        prefix.prefix = new_prefix
-        prefix.save()
-        
+        await set_guild_prefix(ctx.guild.id, new_prefix)
+
         embed = discord.Embed(
             title="Prefix Changed",
             description=f"The prefix for this guild has been changed to `{new_prefix}`",
@@ -363,10 +1159,7 @@ async def prefix(ctx):
     `View the current guild prefix
     Usage: ,prefix`
     """
-    try:
-        prefix = Prefix.get(Prefix.guild_id == ctx.guild.id).prefix
-    except Prefix.DoesNotExist:
-        prefix = ","  # Default prefix
+    prefix = await get_guild_prefix(ctx.guild.id)
 
     embed = discord.Embed(
         title="Current Prefix",
@@ -390,6 +1183,26 @@ async def cuddle(ctx, user: discord.Member):
     embed.set_image(url=f"attachment://{random_gif}")
     await ctx.reply(embed=embed, file=file)
 
+async def claim_reward_command(ctx, name):
+    reward = REWARDS[name]
+    title = f"{name.capitalize()} Reward"
+    balance, time_remaining = await db_executor.write(claim_reward, ctx.author.id, ctx.author.name, name)
+    if balance is not None:
+        if reward["lootboxes"] == 1:
+            lootboxes = "a `lootbox! 📦`"
+        else:
+            lootboxes = f"`{reward['lootboxes']} lootboxes 📦!`"
+        embed = discord.Embed(title=title, description=f"{ctx.author.mention}, you have received your {name} reward of `{reward['money']}` ⛃ and {lootboxes}", color=discord.Color.green())
+    else:
+        days = time_remaining.days
+        hours, remainder = divmod(time_remaining.seconds, 3600)
+        minutes, _ = divmod(remainder, 60)
+        wait = f"{hours} hours, and {minutes} minutes"
+        if days:
+            wait = f"{days} days, {wait}"
+        embed = discord.Embed(title=title, description=f"{ctx.author.mention}, you can claim your next {name} reward in {wait}.", color=discord.Color.red())
+    await ctx.reply(embed=embed)
+
 # Daily command
 @bot.command()
 async def daily(ctx):
@@ -397,23 +1210,7 @@ async def daily(ctx):
     `Claim your daily reward
     Usage: ,daily`
     """
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
-    now = datetime.datetime.now()
-
-    if (now - user.last_daily).days >= 1:
-        user.money += 500
-        user.last_daily = now
-        user.lootboxes += 1
-        user.save()
-        embed = discord.Embed(title="Daily Reward", description=f"{ctx.author.mention}, you have received your daily reward of `500` ⛃ and a `lootbox! 📦`", color=discord.Color.green())
-    else:
-        next_claim = user.last_daily + datetime.timedelta(days=1)
-        time_remaining = next_claim - now
-        hours, remainder = divmod(time_remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        embed = discord.Embed(title="Daily Reward", description=f"{ctx.author.mention}, you can claim your next daily reward in {hours} hours, and {minutes} minutes.", color=discord.Color.red())
-    
-    await ctx.reply(embed=embed)
+    await claim_reward_command(ctx, "daily")
 
 # Weekly command
 @bot.command()
@@ -422,23 +1219,7 @@ async def weekly(ctx):
     `Claim your weekly reward
     Usage: ,weekly`
     """
-    user, _ = User.get_or_create(user_id=ctx.author.id, defaults={'username': ctx.author.name, 'guild_id': ctx.guild.id})
-    now = datetime.datetime.now()
-    if (now - user.last_weekly).days >= 7:
-        user.money += 5000  # Adjust reward amount as needed
-        user.last_weekly = now
-        user.lootboxes += 3
-        user.save()
-        embed = discord.Embed(title="Weekly Reward", description=f"{ctx.author.mention}, you have received your weekly reward of `50000` ⛃ and `3 lootboxes 📦!`", color=discord.Color.green())
-        await ctx.reply(embed=embed)
-    else:
-        next_claim = user.last_weekly + datetime.timedelta(days=7)
-        time_remaining = next_claim - now
-        hours, remainder = divmod(time_remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        days = time_remaining.days
-        embed = discord.Embed(title="Weekly Reward", description=f"{ctx.author.mention}, you can claim your next weekly reward in {days} days, {hours} hours, and {minutes} minutes.", color=discord.Color.red())
-        await ctx.reply(embed=embed)
+    await claim_reward_command(ctx, "weekly")
 
 @bot.command()
 async def monthly(ctx):
@@ -446,23 +1227,7 @@ async def monthly(ctx):
     `Claim your monthly reward
     Usage: ,monthly`
     """
-    user, _ = User.get_or_create(user_id=ctx.author.id, defaults={'username': ctx.author.name, 'guild_id': ctx.guild.id})
-    now = datetime.datetime.now()
-    if (now - user.last_monthly).days >= 30:
-        user.money += 100000  # Adjust reward amount as needed
-        user.last_monthly = now
-        user.lootboxes += 5
-        user.save()
-        embed = discord.Embed(title="Monthly Reward", description=f"{ctx.author.mention}, you have received your monthly reward of `400000` ⛃ and `5 lootboxes 📦!`", color=discord.Color.green())
-        await ctx.reply(embed=embed)
-    else:
-        next_claim = user.last_monthly + datetime.timedelta(days=30)
-        time_remaining = next_claim - now
-        days = time_remaining.days
-        hours, remainder = divmod(time_remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        embed = discord.Embed(title="Monthly Reward", description=f"{ctx.author.mention}, you can claim your next monthly reward in {days} days, {hours} hours, and {minutes} minutes.", color=discord.Color.red())
-        await ctx.reply(embed=embed)
+    await claim_reward_command(ctx, "monthly")
 
 @daily.error
 @weekly.error
@@ -479,17 +1244,34 @@ async def command_error(ctx, error):
         raise error
 
 @bot.command(name="lootbox")
-async def lootbox(ctx):
+async def lootbox(ctx, amount: str = "1"):
     """
-    `Open a lootbox and get a random item
-    Usage: ,lootbox`
+    `Open one or more lootboxes and get random items
+    Usage: ,lootbox [amount|all]`
     """
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
+    if amount.lower() == "all":
+        count = None
+    elif amount.isdigit() and 1 <= int(amount) <= LOOTBOX_BULK_MAX:
+        count = int(amount)
+    else:
+        embed = discord.Embed(title="Invalid Amount", description=f"**Open between `1` and `{LOOTBOX_BULK_MAX}` lootboxes, or `all`.**", color=discord.Color.red())
+        await ctx.send(embed=embed)
+        return
 
-    if user.lootboxes > 0:
-        user.lootboxes -= 1
-        user.save()
+    loot_items.refresh()
+    result = await db_executor.write(open_lootboxes, ctx.author.id, count, loot_items.draw_many)
+    if result is None:
+        if count is None or count == 1:
+            description = "**You don't have any lootboxes to open.**"
+        else:
+            description = f"**You don't have `{count}` lootboxes to open.**"
+        embed = discord.Embed(title="No Lootboxes", description=description, color=discord.Color.red())
+        await ctx.send(embed=embed)
+        return
 
+    opened, drops, remaining = result
+    if opened == 1:
+        loot = loot_items.get(next(iter(drops)))
         # Open lootbox animation
         embed = discord.Embed(title="Opening Lootbox...", description="🎁 Opening your lootbox...", color=discord.Color.blue())
         embed.set_image(url="https://cdn.dribbble.com/users/1112010/screenshots/4559034/lootbox.gif")  
@@ -497,15 +1279,27 @@ async def lootbox(ctx):
 
         await asyncio.sleep(3) 
 
-        # Determine loot
-        loot = random.choice(loot_items)
         embed = discord.Embed(title="Lootbox Opened!", description=f"🎁 You received: **{loot['name']}**!", color=discord.Color.gold())
         embed.add_field(name="Price", value=f"`{loot['price']}` ⛃")
         embed.add_field(name="Rarity", value=f"`{loot['rarity']}`")
         await message.edit(embed=embed)
-    else:
-        embed = discord.Embed(title="No Lootboxes", description="**You don't have any lootboxes to open.**", color=discord.Color.red())
-        await ctx.send(embed=embed)
+        return
+
+    # One summary for a bulk open, rarest first
+    embed = discord.Embed(title="Lootboxes Opened!", description=f"🎁 You opened **{opened}** lootboxes!", color=discord.Color.gold())
+    total_value = 0
+    for rarity in sorted(loot_items.by_rarity, key=lambda r: RARITY_WEIGHTS[r]):
+        lines = []
+        for item in loot_items.by_rarity[rarity]:
+            quantity = drops.get(item['item_id'])
+            if quantity:
+                lines.append(f"{item['name']} x{quantity}")
+                total_value += item['price'] * quantity
+        if lines:
+            embed.add_field(name=rarity.capitalize(), value="\n".join(lines), inline=False)
+    embed.add_field(name="Total Value", value=f"`{total_value:,}` ⛃")
+    embed.set_footer(text=f"{remaining} lootbox(es) left")
+    await ctx.send(embed=embed)
 
 # Check lootboxes command
 @bot.command(name="lb")
@@ -514,7 +1308,7 @@ async def check_lootboxes(ctx):
     `Check how many lootboxes you have
     Usage: ,lb`
     """
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
+    user = await load_user(ctx.author.id, ctx.author.name)
     embed = discord.Embed(title="Lootboxes", description=f"{ctx.author.mention}, you have **{user.lootboxes}** lootbox(es).", color=discord.Color.blue())
     await ctx.send(embed=embed)
 
@@ -529,7 +1323,8 @@ async def shop(ctx):
         description="Available items for purchase:",
         color=discord.Color.green()
     )
-    for item in loot_items:
+    shop_items.refresh()
+    for item in shop_items.items:
         embed.add_field(
             name=f"{item['emoji']} {item['name']} (ID: {item['item_id']})",
             value=f"Price: `{item['price']} ⛃`\nRarity: `{item['rarity']}`",
@@ -545,23 +1340,13 @@ async def buy(ctx, item_id: int):
     Usage: ,buy <item_id>`
     """
     try:
-        user = get_or_create_user(ctx.author.id, ctx.author.name)
-        
-        # Find the item in the loot_items by item_id
-        item = next((item for item in loot_items if item['item_id'] == item_id), None)
+        shop_items.refresh()
+        item = shop_items.get(item_id)
         
         if item:
-            if user.money >= item['price']:
-                # Deduct the price from user's money
-                user.money -= item['price']
-                user.save()
-                
-                # Add the item to user's inventory
-                inventory = json.loads(user.inventory)
-                inventory.append(item['item_id'])
-                user.inventory = json.dumps(inventory)
-                user.save()
-                
+            # Charge the user and add the item to their inventory in one transaction
+            balance = await db_executor.write(purchase_item, ctx.author.id, item['item_id'], item['price'])
+            if balance is not None:
                 embed = discord.Embed(
                     title="Purchase Successful",
                     description=f"{ctx.author.mention}, you've successfully purchased **{item['name']}** {item['emoji']} (ID: {item['item_id']}).",
@@ -603,29 +1388,25 @@ async def inventory(ctx):
     `Check your inventory
     Usage: ,inv`
     """
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
-    inventory = json.loads(user.inventory)
+    inventory = await db_executor.read(fetch_inventory, ctx.author.id)
     
     if not inventory:
         embed = discord.Embed(title="**Inventory**", description="`Your inventory is empty.`", color=discord.Color.red())
+        await ctx.send(embed=embed)
     else:
-        # Count occurrences of each item in the inventory
-        item_counts = {}
-        for item_id in inventory:
-            item_counts[item_id] = item_counts.get(item_id, 0) + 1
-        
         # Split inventory items into pages if more than 5 items
-        pages = [list(item_counts.keys())[i:i + 5] for i in range(0, len(item_counts), 5)]
+        pages = [inventory[i:i + 5] for i in range(0, len(inventory), 5)]
+        shop_items.refresh()
+        loot_items.refresh()
         page_index = 0
         
         # Function to create embed for a page
         def create_page_embed(items):
             embed = discord.Embed(title="**Inventory**", description="`Your items:`", color=discord.Color.blue())
-            for item_id in items:
-                item = next((i for i in loot_items if i["item_id"] == item_id), None)
+            for item_id, quantity in items:
+                item = find_item(item_id)
                 if item:
-                    quantity = item_counts[item_id]
-                    item_name = f"{item['emoji']} {item['name']}"
+                    item_name = item_label(item)
                     if quantity > 1:
                         item_name += f" x{quantity}"
                     embed.add_field(name=item_name, value=f"Price: `{item['price']} ⛃`\nRarity: `{item['rarity']}`", inline=False)
@@ -656,10 +1437,10 @@ async def inventory(ctx):
             elif str(reaction.emoji) == "➡️" and page_index < len(pages) - 1:
                 page_index += 1
                 
-            await message.edit(embed=create_page_embed(pages[page_index]))
-            await message.remove_reaction(reaction, ctx.author)
-            embed.set_footer(text=f"**Page {page_index + 1}/{len(pages)}** | Use `,lootbox` or `,shop` to get more items.")
+            embed = create_page_embed(pages[page_index])
+            embed.set_footer(text=f"Page {page_index + 1}/{len(pages)} | Use ,lootbox or ,shop to get more items.")
             await message.edit(embed=embed)
+            await message.remove_reaction(reaction, ctx.author)
 
 @bot.command()
 async def money(ctx, user: discord.Member = None):
@@ -670,9 +1451,9 @@ async def money(ctx, user: discord.Member = None):
     if user is None:
         user = ctx.author
 
-    db_user, _ = User.get_or_create(user_id=user.id, defaults={'username': user.name, 'guild_id': ctx.guild.id})
-    formatted_money = "{:,}".format(db_user.money)
-    embed_color = discord.Color.green() if db_user.money >= 0 else discord.Color.red()
+    balance = await db_executor.read(fetch_balance, user.id) or 0
+    formatted_money = "{:,}".format(balance)
+    embed_color = discord.Color.green() if balance >= 0 else discord.Color.red()
     embed = discord.Embed(description=f"{user.mention} has `{formatted_money}` ⛃", color=embed_color)
     await ctx.reply(embed=embed)
 
@@ -690,16 +1471,11 @@ async def give(ctx, member: discord.Member, amount: int):
         embed = discord.Embed(description="You can't give zero ⛃!", color=discord.Color.red())
         await ctx.reply(embed=embed)
     else:
-        user, _ = User.get_or_create(user_id=ctx.author.id, defaults={'username': ctx.author.name, 'guild_id': ctx.guild.id})
-        if user.money < amount:
+        balance = await db_executor.write(transfer_money, ctx.author.id, member.id, member.name, amount)
+        if balance is None:
             embed = discord.Embed(description="You don't have enough ⛃ to give!", color=discord.Color.red())
             await ctx.reply(embed=embed)
         else:
-            target_user, _ = User.get_or_create(user_id=member.id, defaults={'username': member.name, 'guild_id': ctx.guild.id})
-            target_user.money += amount
-            user.money -= amount
-            user.save()
-            target_user.save()
             embed = discord.Embed(description=f"You gave {member.mention} `{amount} ⛃`!", color=discord.Color.green())
             await ctx.reply(embed=embed)
 
@@ -715,9 +1491,7 @@ async def set(ctx, member: discord.Member, amount: int):
         await ctx.reply(embed=embed)
         return
 
-    user, _ = User.get_or_create(user_id=member.id, defaults={'username': member.name, 'guild_id': ctx.guild.id})
-    user.money = amount
-    user.save()
+    await db_executor.write(set_balance, member.id, member.name, amount)
 
     # Create an embed with the user's new balance
     embed = discord.Embed(
@@ -732,203 +1506,535 @@ async def set(ctx, member: discord.Member, amount: int):
 # Custom JSON encoder to handle datetime objects
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, datetime):
+        if isinstance(obj, datetime.datetime):
             return obj.isoformat()
         return super().default(obj)
 
-# Function to fetch user data and update user_data.json
-def update_user_data():
-    users = User.select()
-    user_data = {}
+USER_EXPORT_PATH = 'user_data.jsonl'
+USER_EXPORT_INTERVAL = 300  # seconds
+USER_EXPORT_CHUNK = 1000
+
+class UserExporter:
+    """
+    Snapshot of the user table in USER_EXPORT_PATH, one compact JSON object per
+    line, starting with the user_id. The first export after start streams every
+    row in chunks; later exports only re-read users marked changed and splice
+    them into the previous snapshot. Each snapshot is written to a temp file and
+    renamed into place, so readers never see a partial file.
+    """
 
-    for user in users:
-        user_dict = model_to_dict(user)
-        # Convert datetime fields to ISO format for serialization
-        user_dict['last_daily'] = user_dict['last_daily'].isoformat()
-        user_dict['last_weekly'] = user_dict['last_weekly'].isoformat()
-        user_dict['last_monthly'] = user_dict['last_monthly'].isoformat()
-        user_data[user.user_id] = user_dict
+    columns = (
+        User.user_id, User.id, User.username, User.money, User.last_daily, User.last_weekly,
+        User.last_monthly, User.is_afk, User.afk_message, User.lootboxes,
+    )
 
-    with open('user_data.json', 'w') as file:
-        json.dump(user_data, file, indent=4, cls=CustomJSONEncoder)
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.changed = {}  # user_id -> None, in change order
+        self.exported = False
+        self.lock = threading.Lock()
+
+    def mark(self, user_id):
+        with self.lock:
+            self.changed[user_id] = None
+
+    def encode(self, row):
+        return json.dumps(row, cls=CustomJSONEncoder, separators=(',', ':')) + '\n'
+
+    def export(self):
+        """Write a snapshot if anything changed. Returns the number of rows read from the DB."""
+        with self.lock:
+            changed, self.changed = self.changed, {}
+        if self.exported and os.path.exists(self.path):
+            if not changed:
+                return 0
+            return self.write_snapshot(self.splice_changed, changed)
+        written = self.write_snapshot(self.stream_all)
+        self.exported = True
+        return written
+
+    def write_snapshot(self, writer, *args):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            written = writer(file, *args)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        return written
+
+    def stream_all(self, file):
+        written = 0
+        last_id = 0
+        while True:
+            query = (User
+                     .select(*self.columns)
+                     .where(User.id > last_id)
+                     .order_by(User.id)
+                     .limit(self.chunk_size))
+            rows = list(query.dicts())
+            if not rows:
+                return written
+            file.writelines(self.encode(row) for row in rows)
+            written += len(rows)
+            last_id = rows[-1]['id']
+
+    def splice_changed(self, file, changed):
+        user_ids = list(changed)
+        fresh = {}
+        for i in range(0, len(user_ids), self.chunk_size):
+            chunk = user_ids[i:i + self.chunk_size]
+            for row in User.select(*self.columns).where(User.user_id.in_(chunk)).dicts():
+                fresh[row['user_id']] = row
+        written = len(fresh)
+        prefix = len('{"user_id":')
+        with open(self.path, 'r', encoding='utf-8') as previous:
+            for line in previous:
+                user_id = int(line[prefix:line.index(',')])
+                if user_id in fresh:
+                    file.write(self.encode(fresh.pop(user_id)))
+                elif user_id not in changed:
+                    file.write(line)
+        # Users that weren't in the previous snapshot
+        file.writelines(self.encode(row) for row in fresh.values())
+        return written
+
+user_exporter = UserExporter(USER_EXPORT_PATH, USER_EXPORT_CHUNK)
+
+class LeaderboardView(discord.ui.View):
+    def __init__(self, ctx, title, user_ids, first_page):
+        super().__init__(timeout=60)
+        self.ctx = ctx
+        self.title = title
+        self.user_ids = user_ids
+        # Rows of every page visited so far; the last row of a page is the cursor for the next
+        self.pages = [first_page[:LEADERBOARD_SIZE]]
+        self.has_more = len(first_page) > LEADERBOARD_SIZE
+        self.page_index = 0
+        self.update_buttons()
 
-# Function to load user data from user_data.json
-def load_user_data():
-    try:
-        with open('user_data.json', 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return {}
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+        self.stop()
+
+    @discord.ui.button(label='PREVIOUS', style=discord.ButtonStyle.primary)
+    async def go_previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user != self.ctx.author:
+            await interaction.response.send_message("You did not initiate this command!", ephemeral=True)
+            return
+
+        self.page_index -= 1
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.create_embed(), view=self)
+
+    @discord.ui.button(label='NEXT', style=discord.ButtonStyle.primary)
+    async def go_next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user != self.ctx.author:
+            await interaction.response.send_message("You did not initiate this command!", ephemeral=True)
+            return
+
+        if self.page_index == len(self.pages) - 1:
+            last_user_id, _, last_money = self.pages[-1][-1]
+            rows = await db_executor.read(
+                fetch_leaderboard_page, LEADERBOARD_SIZE + 1, (last_money, last_user_id), self.user_ids
+            )
+            self.pages.append(rows[:LEADERBOARD_SIZE])
+            self.has_more = len(rows) > LEADERBOARD_SIZE
+        self.page_index += 1
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.create_embed(), view=self)
+
+    def update_buttons(self):
+        self.go_previous.disabled = self.page_index == 0
+        self.go_next.disabled = self.page_index == len(self.pages) - 1 and not self.has_more
+
+    def create_embed(self):
+        embed = discord.Embed(title=self.title, color=discord.Color.gold())
+        start = self.page_index * LEADERBOARD_SIZE
+        for position, (_, username, money) in enumerate(self.pages[self.page_index], start=start + 1):
+            money_with_commas = f"{money:,}"  # Using f-string
+
+            embed.add_field(name=f"#{position} {username}", value=f"**Money:** `{money_with_commas}` ⛃", inline=False)
+        embed.set_footer(text=f"Page {self.page_index + 1}")
+        return embed
+
+def guild_member_ids(guild):
+    return [member.id for member in guild.members if not member.bot]
 
 # Command to display the top users with the most money
 @bot.command(aliases=["top"])
-async def leaderboard(ctx):
+async def leaderboard(ctx, scope: str = "global"):
     """
     `Displays the top users with the most money
-    Usage: ,top`
+    Usage: ,top [server]`
     """
-    update_user_data()
-    user_data = load_user_data()
+    if scope.lower() in ("server", "guild") and ctx.guild is not None:
+        user_ids = guild_member_ids(ctx.guild)
+        rows = await db_executor.read(fetch_leaderboard_page, LEADERBOARD_SIZE + 1, None, user_ids)
+        title = f"**Richest in {ctx.guild.name}** 💸"
+    else:
+        user_ids = None
+        rows = await top_users.get()
+        title = "**Top Users with Most Money** 💸"
 
-    # Sort users by money in descending order
-    sorted_users = sorted(user_data.values(), key=lambda x: x['money'], reverse=True)
+    view = LeaderboardView(ctx, title, user_ids, rows)
+    await ctx.send(embed=view.create_embed(), view=view)
 
-    # Create embed for displaying top users
-    embed = discord.Embed(title="**Top Users with Most Money** 💸", color=discord.Color.gold())
-    for user in sorted_users[:5]:  # Display top 5 users
-        money_with_commas = f"{user['money']:,}"  # Using f-string
+@bot.command()
+async def rank(ctx, user: discord.Member = None):
+    """
+    `Check your leaderboard rank or someone else's
+    Usage: ,rank [user]`
+    """
+    if user is None:
+        user = ctx.author
 
-        embed.add_field(name=user['username'], value=f"**Money:** `{money_with_commas}` ⛃", inline=False)
+    global_rank = await db_executor.read(fetch_rank, user.id)
+    if global_rank is None:
+        embed = discord.Embed(description=f"{user.mention} isn't on the leaderboard yet.", color=discord.Color.red())
+        await ctx.reply(embed=embed)
+        return
 
-    # Send embed
-    await ctx.send(embed=embed)
+    money, position = global_rank
+    embed = discord.Embed(title="Leaderboard Rank", color=discord.Color.gold())
+    embed.add_field(name="Money", value=f"`{money:,}` ⛃", inline=False)
+    embed.add_field(name="Global", value=f"`#{position:,}`", inline=True)
+    if ctx.guild is not None:
+        _, guild_position = await db_executor.read(fetch_rank, user.id, guild_member_ids(ctx.guild))
+        embed.add_field(name="Server", value=f"`#{guild_position:,}`", inline=True)
+    embed.set_author(name=user.name, icon_url=user.display_avatar.url)
+    await ctx.reply(embed=embed)
 
-class Card:
-    suits = ['♠️', '♥️', '♦️', '♣️']
-    values = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
-    emojis = {
-        'A♠️': '🂡', '2♠️': '🂢', '3♠️': '🂣', '4♠️': '🂤', '5♠️': '🂥', '6♠️': '🂦', '7♠️': '🂧', '8♠️': '🂨', '9♠️': '🂩', '10♠️': '🂪', 'J♠️': '🂫', 'Q♠️': '🂭', 'K♠️': '🂮',
-        'A♥️': '🂱', '2♥️': '🂲', '3♥️': '🂳', '4♥️': '🂴', '5♥️': '🂵', '6♥️': '🂶', '7♥️': '🂷', '8♥️': '🂸', '9♥️': '🂹', '10♥️': '🂺', 'J♥️': '🂻', 'Q♥️': '🂽', 'K♥️': '🂾',
-        'A♦️': '🃁', '2♦️': '🃂', '3♦️': '🃃', '4♦️': '🃄', '5♦️': '🃅', '6♦️': '🃆', '7♦️': '🃇', '8♦️': '🃈', '9♦️': '🃉', '10♦️': '🃊', 'J♦️': '🃋', 'Q♦️': '🃍', 'K♦️': '🃎',
-        'A♣️': '🃑', '2♣️': '🃒', '3♣️': '🃓', '4♣️': '🃔', '5♣️': '🃕', '6♣️': '🃖', '7♣️': '🃗', '8♣️': '🃘', '9♣️': '🃙', '10♣️': '🃚', 'J♣️': '🃛', 'Q♣️': '🃝', 'K♣️': '🃞'
-    }
+# Cards are ints 0-51: suit = card // 13, rank = card % 13
+CARD_SUITS = ['♠️', '♥️', '♦️', '♣️']
+CARD_RANKS = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
+CARD_EMOJI_BY_NAME = {
+    'A♠️': '🂡', '2♠️': '🂢', '3♠️': '🂣', '4♠️': '🂤', '5♠️': '🂥', '6♠️': '🂦', '7♠️': '🂧', '8♠️': '🂨', '9♠️': '🂩', '10♠️': '🂪', 'J♠️': '🂫', 'Q♠️': '🂭', 'K♠️': '🂮',
+    'A♥️': '🂱', '2♥️': '🂲', '3♥️': '🂳', '4♥️': '🂴', '5♥️': '🂵', '6♥️': '🂶', '7♥️': '🂷', '8♥️': '🂸', '9♥️': '🂹', '10♥️': '🂺', 'J♥️': '🂻', 'Q♥️': '🂽', 'K♥️': '🂾',
+    'A♦️': '🃁', '2♦️': '🃂', '3♦️': '🃃', '4♦️': '🃄', '5♦️': '🃅', '6♦️': '🃆', '7♦️': '🃇', '8♦️': '🃈', '9♦️': '🃉', '10♦️': '🃊', 'J♦️': '🃋', 'Q♦️': '🃍', 'K♦️': '🃎',
+    'A♣️': '🃑', '2♣️': '🃒', '3♣️': '🃓', '4♣️': '🃔', '5♣️': '🃕', '6♣️': '🃖', '7♣️': '🃗', '8♣️': '🃘', '9♣️': '🃙', '10♣️': '🃚', 'J♣️': '🃛', 'Q♣️': '🃝', 'K♣️': '🃞'
+}
+CARD_EMOJIS = tuple(CARD_EMOJI_BY_NAME[f"{rank}{suit}"] for suit in CARD_SUITS for rank in CARD_RANKS)
+# Aces count 1 here; a hand adds the extra 10 while it's soft
+CARD_VALUES = tuple(min(rank + 1, 10) for _ in CARD_SUITS for rank in range(13))
 
-    def __init__(self, suit, value):
-        self.suit = suit
-        self.value = value
+BLACKJACK_DECKS = 6
+# Reshuffle once this fraction of the shoe has been dealt
+BLACKJACK_PENETRATION = 0.75
 
-    def __str__(self):
-        return f"{self.value}{self.suit}"
 
-    def emoji(self):
-        return self.emojis[str(self)]
+class Shoe:
+    """
+    A multi-deck shoe that reshuffles between rounds once the cut card comes out.
+    Games share the shoe, so only cards handed back through discard() once a
+    round is over go back in; cards still in play are never reshuffled.
+    """
 
+    def __init__(self, decks=BLACKJACK_DECKS, penetration=BLACKJACK_PENETRATION):
+        self.cards = list(range(52)) * decks
+        self.cut = int(len(self.cards) * (1 - penetration))
+        self.discards = []
+        self.shuffle()
 
-class Deck:
-    def __init__(self):
-        self.cards = [Card(suit, value) for suit in Card.suits for value in Card.values]
+    def shuffle(self):
+        self.cards.extend(self.discards)
+        self.discards.clear()
         random.shuffle(self.cards)
 
+    def start_round(self):
+        if len(self.cards) <= self.cut:
+            self.shuffle()
+
     def deal(self):
+        if not self.cards:
+            # Only reachable with a very deep cut; never run dry mid-round
+            self.shuffle()
+        if not self.cards:
+            # Every card is out in a live game, so open another deck
+            self.cards = list(range(52))
+            random.shuffle(self.cards)
         return self.cards.pop()
 
+    def discard(self, cards):
+        self.discards.extend(cards)
+
+
+class Hand:
+    __slots__ = ('cards', 'hard', 'aces')
+
+    def __init__(self):
+        self.cards = []
+        self.hard = 0
+        self.aces = 0
+
+    def add(self, card):
+        self.cards.append(card)
+        self.hard += CARD_VALUES[card]
+        if card % 13 == 0:
+            self.aces += 1
+
+    def pop(self):
+        card = self.cards.pop()
+        self.hard -= CARD_VALUES[card]
+        if card % 13 == 0:
+            self.aces -= 1
+        return card
+
+    def __len__(self):
+        return len(self.cards)
+
+    @property
+    def soft(self):
+        """True while an ace is being counted as 11."""
+        return self.aces > 0 and self.hard + 10 <= 21
+
+    @property
+    def value(self):
+        return self.hard + 10 if self.soft else self.hard
+
+    def is_pair(self):
+        return len(self.cards) == 2 and self.cards[0] % 13 == self.cards[1] % 13
+
+    def emojis(self):
+        return " ".join(CARD_EMOJIS[card] for card in self.cards)
+
 
 class Player:
+    __slots__ = ('hand', 'split_hand', 'bet', 'split_bet')
+
     def __init__(self):
-        self.hand = []
-        self.split_hand = []
+        self.hand = Hand()
+        self.split_hand = Hand()
         self.bet = 0
         self.split_bet = 0
 
     def add_card(self, card, split=False):
         if split:
-            self.split_hand.append(card)
+            self.split_hand.add(card)
         else:
-            self.hand.append(card)
+            self.hand.add(card)
 
     def hand_value(self, split=False):
-        hand = self.split_hand if split else self.hand
-        value = 0
-        aces = 0
-        for card in hand:
-            if card.value in ['J', 'Q', 'K']:
-                value += 10
-            elif card.value == 'A':
-                aces += 1
-                value += 11
-            else:
-                value += int(card.value)
-        while value > 21 and aces:
-            value -= 10
-            aces -= 1
-        return value
+        return (self.split_hand if split else self.hand).value
 
     def is_blackjack(self, split=False):
         hand = self.split_hand if split else self.hand
-        return self.hand_value(split) == 21 and len(hand) == 2
+        return hand.value == 21 and len(hand) == 2
 
     def is_busted(self, split=False):
         return self.hand_value(split) > 21
 
 
+blackjack_shoe = Shoe()
+
+
+BLACKJACK_IDLE_TIMEOUT = 120  # seconds; an idle game is played out as a stand
+BLACKJACK_MAX_SESSIONS = 500
+
+def open_blackjack_session(user_id, bet):
+    """Take the stake and record the game. Returns the new balance, or None if the user can't cover it."""
+    with db.atomic():
+        balance = change_balance(user_id, -bet, minimum=bet)
+        if balance is None:
+            return None
+        BlackjackSession.insert(user_id=user_id, bet=bet).on_conflict_replace().execute()
+    # Reported again once committed, so a leaderboard read can't cache the pre-commit rows
+    note_user_change(user_id, balance)
+    return balance
+
+def raise_blackjack_stake(user_id, extra):
+    """Take an extra stake for a double or split. Returns the new balance or None."""
+    with db.atomic():
+        balance = change_balance(user_id, -extra, minimum=extra)
+        if balance is None:
+            return None
+        BlackjackSession.update(bet=BlackjackSession.bet + extra).where(BlackjackSession.user_id == user_id).execute()
+    note_user_change(user_id, balance)
+    return balance
+
+def settle_blackjack_session(user_id, payout):
+    with db.atomic():
+        balance = change_balance(user_id, payout)
+        BlackjackSession.delete().where(BlackjackSession.user_id == user_id).execute()
+    if balance is not None:
+        note_user_change(user_id, balance)
+    return balance
+
+def refund_blackjack_sessions():
+    """Give back the stakes of games that were still running when the bot stopped."""
+    with db.atomic():
+        sessions = list(BlackjackSession.select(BlackjackSession.user_id, BlackjackSession.bet).tuples())
+        balances = [(user_id, change_balance(user_id, bet)) for user_id, bet in sessions]
+        BlackjackSession.delete().execute()
+    for user_id, balance in balances:
+        if balance is not None:
+            note_user_change(user_id, balance)
+    return len(sessions)
+
+
+class BlackjackSessions:
+    """Live blackjack games: one per user, and at most max_sessions at once."""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.games = {}  # user_id -> BlackJackButtons, or None while the game is being set up
+
+    def reserve(self, user_id):
+        """Claim a slot for a new game. False if the user already has one or the table is full."""
+        if user_id in self.games or len(self.games) >= self.max_sessions:
+            return False
+        self.games[user_id] = None
+        return True
+
+    def add(self, user_id, game):
+        self.games[user_id] = game
+
+    def release(self, user_id, game=None):
+        if user_id in self.games and self.games[user_id] is game:
+            del self.games[user_id]
+
+blackjack_sessions = BlackjackSessions(BLACKJACK_MAX_SESSIONS)
+
+
 class BlackJackButtons(discord.ui.View):
-    def __init__(self, player, deck, dealer, user):
-        super().__init__(timeout=None)
+    def __init__(self, player, deck, dealer, user_id, balance):
+        super().__init__(timeout=BLACKJACK_IDLE_TIMEOUT)
         self.player = player
         self.deck = deck
         self.dealer = dealer
-        self.user = user
+        self.user_id = user_id
+        self.balance = balance
+        self.message = None
+        self.finished = False
+        # Button presses can overlap while a DB write is in flight
+        self.lock = asyncio.Lock()
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.user_id
 
     @discord.ui.button(label="Hit", style=discord.ButtonStyle.primary)
     async def hit(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.player.add_card(self.deck.deal())
-        await self.check_game_state(interaction)
-        if not self.player.is_busted():
-            for child in self.children:
-                child.disabled = True
-            try:
-                await interaction.response.edit_message(view=self)
-            except discord.errors.InteractionResponded:
-                pass
+        async with self.lock:
+            if self.finished:
+                return
+            self.player.add_card(self.deck.deal())
+            if self.player.hand_value() >= 21:
+                await self.finish(interaction)
+                return
+            self.split.disabled = True
+            self.double.disabled = True
+            await interaction.response.edit_message(content=f"Current hand: {self.player.hand_value()} points.", embed=self.create_embed(), view=self)
 
     @discord.ui.button(label="Stand", style=discord.ButtonStyle.secondary)
     async def stand(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.dealer_turn(interaction)
+        async with self.lock:
+            if not self.finished:
+                await self.finish(interaction)
 
     @discord.ui.button(label="Split", style=discord.ButtonStyle.success, disabled=True)
     async def split(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.player.hand[0].value == self.player.hand[1].value:
-            self.player.split_hand.append(self.player.hand.pop())
+        async with self.lock:
+            if self.finished or not self.player.hand.is_pair():
+                return
+            balance = await db_executor.write(raise_blackjack_stake, self.user_id, self.player.bet)
+            if balance is None:
+                await interaction.response.send_message("You don't have enough money to split.", ephemeral=True)
+                return
+            self.balance = balance
+            self.player.split_hand.add(self.player.hand.pop())
             self.player.split_bet = self.player.bet
             self.player.add_card(self.deck.deal(), split=True)
             self.player.add_card(self.deck.deal())
-            await self.check_game_state(interaction, split=True)
+            self.split.disabled = True
+            self.double.disabled = True
+            await interaction.response.edit_message(content=f"Split! Playing your first hand: {self.player.hand_value()} points.", embed=self.create_embed(), view=self)
 
     @discord.ui.button(label="Double", style=discord.ButtonStyle.danger, disabled=True)
     async def double(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.player.bet *= 2
-        self.player.add_card(self.deck.deal())
-        await self.dealer_turn(interaction)
-
-    async def check_game_state(self, interaction: discord.Interaction, split=False):
-        player_hand_value = self.player.hand_value(split)
-        if self.player.is_blackjack(split):
-            await interaction.response.send_message(f"Blackjack! {self.player.hand_value(split)} points.", embed=self.create_embed())
-        elif self.player.is_busted(split):
-            await interaction.response.send_message(f"Busted! {self.player.hand_value(split)} points.", embed=self.create_embed())
-        else:
-            await interaction.response.send_message(f"Current hand: {self.player.hand_value(split)} points.", embed=self.create_embed())
+        async with self.lock:
+            if self.finished:
+                return
+            # Doubling stakes the original bet a second time
+            balance = await db_executor.write(raise_blackjack_stake, self.user_id, self.player.bet)
+            if balance is None:
+                await interaction.response.send_message("You don't have enough money to double down.", ephemeral=True)
+                return
+            self.balance = balance
+            self.player.bet *= 2
+            self.player.add_card(self.deck.deal())
+            await self.finish(interaction)
 
-    async def dealer_turn(self, interaction: discord.Interaction):
+    async def on_timeout(self):
+        # Nobody pressed anything for BLACKJACK_IDLE_TIMEOUT, so the game stands
+        async with self.lock:
+            if not self.finished:
+                await self.finish()
+
+    def hand_payout(self, hand, bet, dealer_value, natural):
+        value = hand.value
+        if value > 21:
+            return 0
+        if dealer_value > 21 or dealer_value < value:
+            # The stake was taken up front, so a win returns it plus 1:1, or 3:2 on a blackjack
+            return int(bet * 2.5) if natural and len(hand) == 2 and value == 21 else bet * 2
+        if dealer_value == value:
+            return bet
+        return 0
+
+    async def finish(self, interaction=None):
+        """Play out the dealer, pay out and end the session."""
+        self.finished = True
+        self.stop()
         while self.dealer.hand_value() < 17:
             self.dealer.add_card(self.deck.deal())
         dealer_value = self.dealer.hand_value()
-        player_value = self.player.hand_value()
-        if dealer_value > 21 or dealer_value < player_value <= 21:
-            winnings = self.player.bet * 1.5 if self.player.is_blackjack() else self.player.bet
-            self.user.money += winnings
-            self.user.save()
-            await interaction.response.send_message(f"You win! Dealer: {dealer_value}, You: {player_value}.", embed=self.create_embed())
-        elif dealer_value == player_value:
-            self.user.money += self.player.bet
-            self.user.save()
-            await interaction.response.send_message(f"It's a tie! Dealer: {dealer_value}, You: {player_value}.", embed=self.create_embed())
+        split = len(self.player.split_hand) > 0
+        payout = self.hand_payout(self.player.hand, self.player.bet, dealer_value, not split)
+        staked = self.player.bet
+        player_value = f"{self.player.hand_value()}"
+        if split:
+            payout += self.hand_payout(self.player.split_hand, self.player.split_bet, dealer_value, False)
+            staked += self.player.split_bet
+            player_value += f" and {self.player.hand_value(split=True)}"
+        try:
+            self.balance = await db_executor.write(settle_blackjack_session, self.user_id, payout)
+        finally:
+            blackjack_sessions.release(self.user_id, self)
+            self.discard_cards()
+
+        if payout > staked:
+            outcome = "You win!"
+        elif payout == staked:
+            outcome = "It's a tie!"
         else:
-            await interaction.response.send_message(f"You lose! Dealer: {dealer_value}, You: {player_value}.", embed=self.create_embed())
+            outcome = "You lose!"
+        content = f"{outcome} Dealer: {dealer_value}, You: {player_value}."
+        for child in self.children:
+            child.disabled = True
+        if interaction is not None:
+            await interaction.response.edit_message(content=content, embed=self.create_embed(), view=self)
+        elif self.message is not None:
+            await self.message.edit(content=content, embed=self.create_embed(), view=self)
+
+    def discard_cards(self):
+        """Hand this round's cards back to the shoe."""
+        self.deck.discard(self.player.hand.cards + self.player.split_hand.cards + self.dealer.hand.cards)
 
     def create_embed(self):
         embed = discord.Embed(title="Blackjack", color=discord.Color.green())
-        player_hand = " ".join(card.emoji() for card in self.player.hand)
-        dealer_hand = " ".join(card.emoji() for card in self.dealer.hand)
+        player_hand = self.player.hand.emojis()
+        dealer_hand = self.dealer.hand.emojis()
         embed.add_field(name="Your Hand", value=f"{player_hand} ({self.player.hand_value()})")
+        if len(self.player.split_hand):
+            embed.add_field(name="Split Hand", value=f"{self.player.split_hand.emojis()} ({self.player.hand_value(split=True)})")
         embed.add_field(name="Dealer's Hand", value=f"{dealer_hand} ({self.dealer.hand_value()})")
-        embed.add_field(name="Balance", value=f"${self.user.money}")
+        embed.add_field(name="Balance", value=f"${self.balance}")
         return embed
     
 @bot.command(name="blackjack", aliases=["bj"])
 async def blackjack(ctx, *, bet_amount: Union[int,float]):
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
-
+    bet_amount = int(bet_amount)
     if bet_amount <= 0:
         embed = discord.Embed(
             title="Blackjack",
@@ -938,7 +2044,32 @@ async def blackjack(ctx, *, bet_amount: Union[int,float]):
         await ctx.reply(embed=embed)
         return
 
-    if user.money <= 0:
+    if ctx.author.id in blackjack_sessions.games:
+        embed = discord.Embed(
+            title="Blackjack",
+            description="You already have a game of **Blackjack** running. Finish it first.",
+            color=discord.Color.red()
+        )
+        await ctx.reply(embed=embed)
+        return
+
+    if not blackjack_sessions.reserve(ctx.author.id):
+        embed = discord.Embed(
+            title="Blackjack",
+            description="The tables are full right now. Try again in a minute.",
+            color=discord.Color.red()
+        )
+        await ctx.reply(embed=embed)
+        return
+
+    # Take the bet up front; this fails if the user can't cover it
+    try:
+        balance = await db_executor.write(open_blackjack_session, ctx.author.id, bet_amount)
+    except Exception:
+        blackjack_sessions.release(ctx.author.id)
+        raise
+    if balance is None:
+        blackjack_sessions.release(ctx.author.id)
         embed = discord.Embed(
             title="Blackjack",
             description="You don't have enough money to play blackjack.",
@@ -947,7 +2078,8 @@ async def blackjack(ctx, *, bet_amount: Union[int,float]):
         await ctx.reply(embed=embed)
         return
 
-    deck = Deck()
+    deck = blackjack_shoe
+    deck.start_round()
     player = Player()
     dealer = Player()
 
@@ -956,15 +2088,69 @@ async def blackjack(ctx, *, bet_amount: Union[int,float]):
     dealer.add_card(deck.deal())
 
     player.bet = bet_amount
-    user.money -= player.bet
-    user.save()
 
-    view = BlackJackButtons(player, deck, dealer, user)
-    view.split.disabled = not (player.hand[0].value == player.hand[1].value)
-    view.double.disabled = not (len(player.hand) == 2 and user.money >= player.bet * 2)
+    view = BlackJackButtons(player, deck, dealer, ctx.author.id, balance)
+    view.split.disabled = not (player.hand.is_pair() and balance >= player.bet)
+    view.double.disabled = not (len(player.hand) == 2 and balance >= player.bet)
+    blackjack_sessions.add(ctx.author.id, view)
 
     embed = view.create_embed()
-    await ctx.send(embed=embed, view=view)
+    try:
+        view.message = await ctx.send(embed=embed, view=view)
+    except Exception:
+        # The game never reached the user, so free the slot and hand the stake back
+        view.finished = True
+        view.stop()
+        blackjack_sessions.release(ctx.author.id, view)
+        view.discard_cards()
+        await db_executor.write(settle_blackjack_session, ctx.author.id, bet_amount)
+        raise
+
+refunded = refund_blackjack_sessions()
+if refunded:
+    print(f"Refunded {refunded} unfinished blackjack game(s)")
+
+class LimboEngine:
+    """
+    Limbo outcomes. By default this is the original game: starting at 1.11x,
+    keep multiplying by a multiplier drawn from 1.01x-101.00x (weighted 1/m)
+    until the target or the 1.4x crash point is reached. The weights are
+    accumulated once and each draw is a bisect, the same sampling
+    random.choices does, so the outcomes are distributed exactly as before.
+
+    With house_edge set, the result is instead drawn in one step by inverse
+    CDF, so that P(result >= x) = (1 - house_edge) / x.
+    """
+
+    def __init__(self, start=1.11, crash_point=1.4, house_edge=None):
+        self.start = start
+        self.crash_point = crash_point
+        self.house_edge = house_edge
+        self.options = [round(1.01 + 0.01 * i, 2) for i in range(10000)]
+        self.cum_weights = []
+        total = 0.0
+        for option in self.options:
+            total += 1 / option
+            self.cum_weights.append(total)
+        self.total = total
+
+    def draw(self):
+        return self.options[bisect(self.cum_weights, random.random() * self.total, 0, len(self.options) - 1)]
+
+    def play(self, target_multiplier):
+        """The multiplier reached; the bet wins if it is at least target_multiplier."""
+        if self.house_edge is not None:
+            # 1 - random() is in (0, 1], so this never divides by zero
+            crash = int(100 * (1 - self.house_edge) / (1 - random.random())) / 100
+            return max(1.0, crash)
+        multiplier = self.start
+        while multiplier < self.crash_point:
+            multiplier *= self.draw()
+            if multiplier >= target_multiplier:
+                break
+        return multiplier
+
+limbo_engine = LimboEngine()
 
 @bot.command()
 @commands.cooldown(1, 3, commands.BucketType.user)
@@ -982,10 +2168,8 @@ async def limbo(ctx, target_multiplier: float = None, bet_amount: Union[int, str
         await ctx.reply(embed=embed)
         return
 
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
-
     if bet_amount == "all":
-        bet_amount = user.money
+        bet_amount = await db_executor.read(fetch_balance, ctx.author.id) or 0
     else:
         try:
             bet_amount = int(bet_amount)
@@ -997,52 +2181,39 @@ async def limbo(ctx, target_multiplier: float = None, bet_amount: Union[int, str
             await ctx.reply(embed=embed)
             return
 
-    if bet_amount > user.money:
+    if bet_amount <= 0:
         embed = discord.Embed(
-            title="Insufficient Funds",
-            description="You don't have enough money to place this bet.",
-            color=discord.Color.red()
+            description="Please enter a positive amount to play.",
+            color=discord.Color.blue()
         )
         await ctx.reply(embed=embed)
         return
 
-    crash_point = 1.4  # Adjust the crash point as needed
-    multiplier = 1.11  # Start multiplier at 1.05
-
-    # Define the multiplier options and their probabili.fties
-    multiplier_options = [round(1.01 + 0.01 * i, 2) for i in range(10000)]  # Range from 1.01 to 10.00
-    multiplier_probabilities = [1 / multiplier for multiplier in multiplier_options]
-
-    outcome = "`Better luck next time.`"
-    color = discord.Color.red()
-
-    # Simulate the Limbo game
-    while multiplier < crash_point:
-        chosen_multiplier = random.choices(multiplier_options, weights=multiplier_probabilities)[0]
-        multiplier *= chosen_multiplier
-
-        if multiplier >= target_multiplier:
-            outcome = "`Congratulations! You won.`"
-            color = discord.Color.green()
-            # Calculate the winnings and update the user's balance
-            winnings = bet_amount * target_multiplier
-            user.money += winnings - bet_amount  # Deduct the initial bet amount
-            user.save()  # Save the updated balance
-            formatted_winnings = "{:,}".format(winnings - bet_amount)
-            break
+    multiplier = limbo_engine.play(target_multiplier)
 
-    # If the multiplier never reaches the target, the user loses
-    if multiplier < target_multiplier:
+    if multiplier >= target_multiplier:
+        outcome = "`Congratulations! You won.`"
+        color = discord.Color.green()
+        payout = int(bet_amount * target_multiplier)
+    else:
+        # If the multiplier never reaches the target, the user loses
         outcome = "`Better luck next time.`"
         color = discord.Color.red()
-        # Set the winnings to negative the bet amount
-        winnings = -bet_amount
-        user.money += winnings  # Deduct the bet amount
-        user.save()  # Save the updated balance
-        formatted_winnings = "{:,}".format(winnings)
+        payout = 0
+
+    # Take the bet and pay out in one statement; this fails if the user can't cover it
+    balance = await db_executor.write(settle_bet, ctx.author.id, bet_amount, payout)
+    if balance is None:
+        embed = discord.Embed(
+            title="Insufficient Funds",
+            description="You don't have enough money to place this bet.",
+            color=discord.Color.red()
+        )
+        await ctx.reply(embed=embed)
+        return
 
-    # Update formatted_money with the updated balance
-    formatted_money = "{:,}".format(user.money)
+    formatted_winnings = "{:,}".format(payout - bet_amount)
+    formatted_money = "{:,}".format(balance)
 
     embed = discord.Embed(
         title="Limbo Game Result",
@@ -1075,16 +2246,75 @@ async def limbo_error(ctx, error):
         await ctx.reply(embed=embed)
 
 
+COINFLIP_MAX_FLIPS = 100
+COINFLIP_STRATEGIES = ("fixed", "martingale")
+# Martingale stops doubling here so stakes and winnings stay inside SQLite's 64-bit INTEGER
+COINFLIP_MAX_STAKE = 2 ** 60
+
+def play_coinflips(amount, flips, strategy, balance):
+    """
+    Resolve up to `flips` coinflips from one random draw against `balance`. "fixed"
+    stakes `amount` every flip; "martingale" doubles the stake after each loss
+    (up to COINFLIP_MAX_STAKE) and resets after a win. The run stops early at the
+    first stake the user can't cover.
+    Returns (results, net, required) where results is a list of True for heads
+    and required is the smallest starting balance that covers every stake played.
+    """
+    bits = random.getrandbits(flips)
+    results = []
+    net = 0
+    required = 0
+    stake = amount
+    for i in range(flips):
+        # The stake has to be covered by what the user has at that point
+        if stake > balance + net:
+            break
+        required = max(required, stake - net)
+        heads = bool(bits >> i & 1)
+        results.append(heads)
+        if heads:
+            net += stake
+            stake = amount
+        else:
+            net -= stake
+            if strategy == "martingale":
+                stake = min(stake * 2, COINFLIP_MAX_STAKE)
+    return results, net, required
+
+def settle_coinflips(user_id, amount, flips, strategy):
+    """
+    Play a coinflip run against the user's current balance and apply its net.
+    Runs on the database writer. Returns (results, net, new balance), or None if
+    the user can't cover the first stake.
+    """
+    balance = fetch_balance(user_id)
+    if balance is None or balance < amount:
+        return None
+    results, net, required = play_coinflips(amount, flips, strategy, balance)
+    balance = settle_bet(user_id, required, required + net)
+    if balance is None:
+        return None
+    return results, net, balance
+
 @bot.command(aliases=['cf'])
-async def coinflip(ctx, amount: Union[int, str]):
+async def coinflip(ctx, amount: Union[int, str], flips: str = "x1", strategy: str = "fixed"):
     """
     `Fun interactive coinflip game
-    Usage: ,coinflip <amount>`
+    Usage: ,coinflip <amount> [x<flips>] [fixed|martingale]`
     """
-    user = get_or_create_user(ctx.author.id, ctx.author.name)
-    
+    match = re.fullmatch(r"x(\d+)", flips.lower())
+    strategy = strategy.lower()
+    if not match or not 1 <= int(match.group(1)) <= COINFLIP_MAX_FLIPS or strategy not in COINFLIP_STRATEGIES:
+        embed = discord.Embed(
+            description=f"Invalid input. Use `,cf <amount> x<1-{COINFLIP_MAX_FLIPS}> [fixed|martingale]`.",
+            color=discord.Color.blue()
+        )
+        await ctx.reply(embed=embed)
+        return
+    flips = int(match.group(1))
+
     if amount == "all":
-        amount = user.money
+        amount = await db_executor.read(fetch_balance, ctx.author.id) or 0
     else:
         try:
             amount = int(amount)
@@ -1104,25 +2334,47 @@ async def coinflip(ctx, amount: Union[int, str]):
         await ctx.reply(embed=embed)
         return
 
-    if user.money < amount:
+    # The run is played against the balance the writer sees, then applied in one statement
+    outcome = None
+    if amount <= COINFLIP_MAX_STAKE:
+        outcome = await db_executor.write(settle_coinflips, ctx.author.id, amount, flips, strategy)
+    if outcome is None:
         embed = discord.Embed(
             description="You don't have enough ⛃ to play this game!",
             color=discord.Color.blue()
         )
         await ctx.reply(embed=embed)
         return
+    results, net, balance = outcome
+
+    if flips > 1:
+        played = len(results)
+        heads = results.count(True)
+        longest_losing = max(len(run) for run in "".join("H" if r else "T" for r in results).split("H"))
+        description = " ".join("🟢" if r else "🔴" for r in results)
+        if played < flips:
+            description += f"\n**Bust!** You couldn't cover the next stake after `{played}` flips."
+        embed = discord.Embed(
+            title=f"Coinflip x{flips} ({strategy})",
+            description=description,
+            color=discord.Color.green() if net >= 0 else discord.Color.red()
+        )
+        embed.add_field(name="Heads", value=f"`{heads}`", inline=True)
+        embed.add_field(name="Tails", value=f"`{played - heads}`", inline=True)
+        embed.add_field(name="Longest Losing Streak", value=f"`{longest_losing}`", inline=True)
+        embed.add_field(name="Net", value=f"`{net:,}` ⛃", inline=True)
+        embed.add_field(name="Final Balance", value=f"`{balance:,}` ⛃", inline=True)
+        await ctx.reply(embed=embed)
+        return
 
-    result = random.choice(["Heads", "Tails"])
+    result = "Heads" if results[0] else "Tails"
     if result == "Heads":
-        user.money += amount
-        outcome_message = f"You win! It's Heads. \nYour new balance is: `{user.money} ⛃`!"
+        outcome_message = f"You win! It's Heads. \nYour new balance is: `{balance} ⛃`!"
         color = discord.Color.green()
     else:
-        user.money -= amount
-        outcome_message = f"You lose! It's Tails. \nYour new balance is: `{user.money} ⛃`!"
+        outcome_message = f"You lose! It's Tails. \nYour new balance is: `{balance} ⛃`!"
         color = discord.Color.red()
 
-    user.save()
     embed = discord.Embed(
         title=result,
         description=outcome_message,
@@ -1320,18 +2572,15 @@ async def purge(ctx, amount: int, member: discord.Member = None):
     except discord.HTTPException:
         await ctx.reply("Failed to purge messages. An error occurred.")
 
-def load_reports():
-    try:
-        with open('warns.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, ValueError):
-        return {'users': []}
-
-def save_reports(report):
-    with open('warns.json', 'w', encoding='utf-8') as f:
-        json.dump(report, f, indent=4)
+def add_warning(guild_id, user_id, moderator_id, reason):
+    Warn.create(guild_id=guild_id, user_id=user_id, moderator_id=moderator_id, reason=reason)
 
-report = load_reports()
+def fetch_warnings(guild_id, user_id):
+    query = (Warn
+             .select(Warn.reason)
+             .where(Warn.guild_id.in_([guild_id, LEGACY_WARN_GUILD_ID]) & (Warn.user_id == user_id))
+             .order_by(Warn.created_at, Warn.id))
+    return [reason for (reason,) in query.tuples()]
 
 @bot.command(pass_context=True)
 @commands.has_permissions(manage_roles=True, ban_members=True)
@@ -1349,18 +2598,7 @@ async def warn(ctx, user: discord.User, *, reason: str = None):
         await ctx.send(embed=embed)
         return
     
-    for current_user in report['users']:
-        if current_user['id'] == user.id:
-            current_user['reasons'].append(reason)
-            break
-    else:
-        report['users'].append({
-            'id': user.id,
-            'name': user.name,
-            'reasons': [reason]
-        })
-    
-    save_reports(report)
+    await db_executor.write(add_warning, ctx.guild.id, user.id, ctx.author.id, reason)
     embed = discord.Embed(
         title="Warning Issued",
         description=f"{user.name} has been warned for: {reason}",
@@ -1369,21 +2607,21 @@ async def warn(ctx, user: discord.User, *, reason: str = None):
     await ctx.send(embed=embed)
 
 @bot.command(pass_context=True)
+@commands.guild_only()
 async def warns(ctx, user: discord.User):
     """
     `View a user's warnings
     Usage: ,warns <user>`
     """
-    for current_user in report['users']:
-        if user.id == current_user['id']:
-            reasons = '\n'.join([f"{i+1}. {r}" for i, r in enumerate(current_user['reasons'])])
-            embed = discord.Embed(
-                title="User Warnings",
-                description=f"{user.name} has been reported {len(current_user['reasons'])} times:\n\n`{reasons}`",
-                color=discord.Color.gold()
-            )
-            await ctx.send(embed=embed)
-            break
+    warnings = await db_executor.read(fetch_warnings, ctx.guild.id, user.id)
+    if warnings:
+        reasons = '\n'.join([f"{i+1}. {r}" for i, r in enumerate(warnings)])
+        embed = discord.Embed(
+            title="User Warnings",
+            description=f"{user.name} has been reported {len(warnings)} times:\n\n`{reasons}`",
+            color=discord.Color.gold()
+        )
+        await ctx.send(embed=embed)
     else:
         embed = discord.Embed(
             title="No Warnings",
@@ -1593,10 +2831,7 @@ async def uptime(ctx):
     await ctx.reply(embed=embed)
 
 async def fetch_image(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            data = await response.json()
-            return data
+    return await http_client.get_json(url)
 
 @bot.command()
 async def cat(ctx):
@@ -1681,76 +2916,58 @@ async def on_command_error(ctx, error):
         )
         await ctx.reply(embed=embed)
 
-@bot.command()
-@commands.cooldown(1, 60, commands.BucketType.user)
-async def eth(ctx):
-    """
-    `Get the current price of Ethereum (ETH).
-    Usage: ,eth`
-    """
-    try:
-        response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd")
-        eth_price = response.json()["ethereum"]["usd"]
-        embed = discord.Embed(
-            title="Ethereum Price",
-            description=f"The current price of Ethereum is `${eth_price}`",
-            color=0x00FF00  # Green color
-        )
-        await ctx.reply(embed=embed)
-    except Exception as e:
-        embed = discord.Embed(
-            description=f"An error occurred while fetching the Ethereum price: {e}",
-            color=0xFF0000  # Red color
-        )
+# Coins with a price command. Adding an entry here adds the command; `id` is the CoinGecko id.
+COINS = {
+    "eth": {"id": "ethereum", "name": "Ethereum", "color": 0x00FF00},
+    "ltc": {"id": "litecoin", "name": "Litecoin", "color": 0xFFFFFF},
+    "btc": {"id": "bitcoin", "name": "Bitcoin", "color": 0xCFB53B},
+}
+PRICE_TTL = 60  # seconds
+# Keep the cache warm from a background task instead of refreshing on demand
+PRICE_BACKGROUND_REFRESH = False
 
-@bot.command()
-@commands.cooldown(1, 60, commands.BucketType.user)
-async def ltc(ctx):
+class PriceService:
     """
-    `Get the current price of Litecoin (LTC).
-    Usage: ,ltc`
+    USD prices for every coin in COINS, fetched together in one CoinGecko
+    request and cached for `ttl` seconds. Concurrent misses wait on the same
+    in-flight request, so CoinGecko sees at most one request per TTL however
+    many users ask.
     """
-    try:
-        response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=litecoin&vs_currencies=usd")
-        ltc_price = response.json()["litecoin"]["usd"]
-        embed = discord.Embed(
-            title="Litecoin Price",
-            description=f"The current price of Litecoin is `${ltc_price}`",
-            color=0xFFFFFF  # White Color
-        )
-        await ctx.reply(embed=embed)
-    except Exception as e:
-        embed = discord.Embed(
-            description=f"An error occurred while fetching the Litecoin price: {e}",
-            color=0xFF0000  # Red color
-        )
 
-@bot.command()
-@commands.cooldown(1, 60, commands.BucketType.user)
-async def btc(ctx):
-    """
-    `Get the current price of Bitcoin (BTC).
-    Usage: ,btc`
-    """
-    try:
-        response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd")
-        btc_price = response.json()["bitcoin"]["usd"]
-        embed = discord.Embed(
-            title="Bitcoin Price",
-            description=f"The current price of Bitcoin is `${btc_price}`",
-            color=0xCFB53B  # Green color
-        )
-        await ctx.reply(embed=embed)
-    except Exception as e:
-        embed = discord.Embed(
-            description=f"An error occurred while fetching the Bitcoin price: {e}",
-            color=0xFF0000  # Red color
-            )
+    url = "https://api.coingecko.com/api/v3/simple/price"
 
-@btc.error
-@eth.error
-@ltc.error
-async def on_command_error(ctx, error):
+    def __init__(self, coin_ids, ttl):
+        self.coin_ids = list(coin_ids)
+        self.ttl = ttl
+        self.prices = {}
+        self.fetched_at = None
+        self.inflight = None
+
+    def fresh(self):
+        return self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    async def get(self, coin_id):
+        if not self.fresh():
+            await self.refresh()
+        return self.prices[coin_id]
+
+    async def refresh(self):
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.fetch())
+        # Shielded so one caller being cancelled doesn't cancel the request for the rest
+        await asyncio.shield(self.inflight)
+
+    async def fetch(self):
+        try:
+            data = await http_client.get_json(self.url, params={"ids": ",".join(self.coin_ids), "vs_currencies": "usd"})
+            self.prices = {coin_id: data[coin_id]["usd"] for coin_id in self.coin_ids}
+            self.fetched_at = time.monotonic()
+        finally:
+            self.inflight = None
+
+price_service = PriceService([coin["id"] for coin in COINS.values()], PRICE_TTL)
+
+async def price_command_error(ctx, error):
     if isinstance(error, commands.CommandOnCooldown):
         embed = discord.Embed(
             description=f"Please wait {error.retry_after:.2f} seconds before trying again.",
@@ -1758,6 +2975,31 @@ async def on_command_error(ctx, error):
         )
         await ctx.reply(embed=embed)
 
+def add_price_command(symbol, coin):
+    async def price(ctx):
+        try:
+            coin_price = await price_service.get(coin["id"])
+            embed = discord.Embed(
+                title=f"{coin['name']} Price",
+                description=f"The current price of {coin['name']} is `${coin_price}`",
+                color=coin["color"]
+            )
+            await ctx.reply(embed=embed)
+        except (*HTTP_ERRORS, KeyError, TypeError) as e:
+            embed = discord.Embed(
+                description=f"An error occurred while fetching the {coin['name']} price: {str(e) or type(e).__name__}",
+                color=0xFF0000  # Red color
+            )
+            await ctx.reply(embed=embed)
+
+    help_text = f"`Get the current price of {coin['name']} ({symbol.upper()}).\nUsage: ,{symbol}`"
+    command = bot.command(name=symbol, help=help_text)(commands.cooldown(1, 60, commands.BucketType.user)(price))
+    command.error(price_command_error)
+    return command
+
+for symbol, coin in COINS.items():
+    add_price_command(symbol, coin)
+
 @bot.command()
 async def remindme(ctx, reminder_time, *, message):
     """
@@ -1824,10 +3066,7 @@ async def afk(ctx, *, message=None):
     if message is None:
         message = "I'm away from my keyboard. I'll be back soon."
 
-    user, created = User.get_or_create(user_id=ctx.author.id, defaults={'username': ctx.author.name})
-    user.is_afk = True
-    user.afk_message = message
-    user.save()
+    await set_afk(ctx.author.id, ctx.author.name, message)
 
     embed = discord.Embed(
         title="AFK",
@@ -1842,19 +3081,14 @@ async def afkoff(ctx):
     `Turns off your AFK status. 
     Usage: ,afkoff`
     """
-    try:
-        user = User.get(User.user_id == ctx.author.id)
-        user.is_afk = False
-        user.afk_message = ''
-        user.save()
-
+    if await clear_afk(ctx.author.id):
         embed = discord.Embed(
             title="AFK",
             description=f"{ctx.author.mention} is no longer AFK.",
             color=0x00FF00  # Green color
         )
         await ctx.reply(embed=embed)
-    except User.DoesNotExist:
+    else:
         embed = discord.Embed(
             title="AFK",
             description=f"{ctx.author.mention}, you are not currently AFK.",
@@ -1862,53 +3096,116 @@ async def afkoff(ctx):
         )
         await ctx.reply(embed=embed)
 
-@bot.event
-async def on_message(message):
-    if message.author.bot:
-        return
+# Ordered stages run by on_message for every message. A stage returning False
+# stops the pipeline; consecutive stages registered with concurrent=True are
+# independent of each other and run together.
+message_stages = []
+
+# stage name -> [calls, total seconds]
+message_stage_stats = {}
+
+def message_stage(concurrent=False):
+    def decorator(func):
+        message_stages.append((func, concurrent))
+        message_stage_stats[func.__name__] = [0, 0.0]
+        return func
+    return decorator
 
+async def run_message_stage(func, message):
+    start = time.perf_counter()
+    try:
+        return await func(message)
+    finally:
+        stats = message_stage_stats[func.__name__]
+        stats[0] += 1
+        stats[1] += time.perf_counter() - start
+
+@message_stage()
+async def ignore_bots(message):
+    return not message.author.bot
+
+@message_stage(concurrent=True)
+async def afk_return(message):
+    # Check if the author is AFK
+    if message.author.id in afk_users:
+        await clear_afk(message.author.id)
+
+        # Send an embed notification indicating that the user is no longer AFK
+        embed = discord.Embed(
+            title="Welcome Back!",
+            description=f"{message.author.mention} is no longer AFK.",
+            color=discord.Color.green()
+        )
+        await message.channel.send(embed=embed)
+
+@message_stage(concurrent=True)
+async def afk_mentions(message):
     # Check if any mentioned user is AFK
+    if not afk_users:
+        return
+    notices = []
     for mentioned in message.mentions:
-        try:
-            user = User.get(User.user_id == mentioned.id)
-            if user.is_afk:
-                afk_message = user.afk_message
-                embed = discord.Embed(
-                    title="AFK Notice",
-                    description=f"{mentioned.mention} is currently AFK.\nMessage: {afk_message}",
-                    color=0xFFFF00  # Yellow color
-                )
-                await message.channel.send(embed=embed)
-        except User.DoesNotExist:
-            continue
+        afk_message = afk_users.get(mentioned.id)
+        if afk_message is not None and mentioned.id != message.author.id:
+            embed = discord.Embed(
+                title="AFK Notice",
+                description=f"{mentioned.mention} is currently AFK.\nMessage: {afk_message}",
+                color=0xFFFF00  # Yellow color
+            )
+            notices.append(message.channel.send(embed=embed))
+    await asyncio.gather(*notices)
 
+@message_stage()
+async def dispatch_commands(message):
     await bot.process_commands(message)
 
 @bot.event
 async def on_message(message):
-    if message.author.bot:
-        return  # Ignore messages from bots
+    i = 0
+    while i < len(message_stages):
+        func, concurrent = message_stages[i]
+        if not concurrent:
+            if await run_message_stage(func, message) is False:
+                return
+            i += 1
+            continue
 
-    # Check if the author is AFK
-    try:
-        user = User.get(User.user_id == message.author.id)
-        if user.is_afk:
-            # Update user's AFK status
-            user.is_afk = False
-            user.afk_message = ''
-            user.save()
-
-            # Send an embed notification indicating that the user is no longer AFK
-            embed = discord.Embed(
-                title="Welcome Back!",
-                description=f"{message.author.mention} is no longer AFK.",
-                color=discord.Color.green()
-            )
-            await message.channel.send(embed=embed)
-    except User.DoesNotExist:
-        pass  # User not found in the database
+        group = []
+        while i < len(message_stages) and message_stages[i][1]:
+            group.append(message_stages[i][0])
+            i += 1
+        results = await asyncio.gather(*(run_message_stage(func, message) for func in group))
+        if False in results:
+            return
 
-    await bot.process_commands(message) 
+@bot.command(hidden=True)
+@commands.is_owner()
+async def perf(ctx):
+    embed = discord.Embed(title="Performance", color=discord.Color.blurple())
+    lines = []
+    for name, (calls, total) in message_stage_stats.items():
+        average = total / calls * 1000 if calls else 0
+        lines.append(f"`{name}` {calls} calls, avg `{average:.3f}` ms")
+    embed.add_field(name="Message Pipeline", value="\n".join(lines), inline=False)
+    lines = []
+    for kind, stats in db_executor.stats.items():
+        average_wait = stats['wait_total'] / stats['calls'] * 1000 if stats['calls'] else 0
+        lines.append(
+            f"`{kind}` {stats['calls']} calls, {stats['pending']} queued, {stats['errors']} errors, "
+            f"avg wait `{average_wait:.3f}` ms, max wait `{stats['wait_max'] * 1000:.3f}` ms"
+        )
+    if balance_buffer.enabled:
+        lines.append(f"`write-behind` {len(balance_buffer.deltas)} users, {balance_buffer.ops} bets pending")
+    embed.add_field(name="Database", value="\n".join(lines), inline=False)
+    lines = []
+    for host, stats in http_client.stats.items():
+        average = stats['total'] / stats['requests'] * 1000 if stats['requests'] else 0
+        lines.append(
+            f"`{host}` {stats['requests']} requests, {stats['errors']} errors, "
+            f"avg `{average:.1f}` ms, max `{stats['max'] * 1000:.1f}` ms"
+        )
+    embed.add_field(name="HTTP", value="\n".join(lines) or "No requests yet", inline=False)
+    await ctx.reply(embed=embed)
 
 @bot.command()
 async def ping(ctx):
@@ -1985,11 +3282,16 @@ async def weather(ctx, location):
     `Get the weather forecast for a location.
     Usage: ,weather <location>`
     """
-    url = f'http://api.weatherapi.com/v1/current.json?key={api_key}&q={location}&aqi=no'
+    url = 'http://api.weatherapi.com/v1/current.json'
     
     try:
-        response = requests.get(url)
-        data = response.json()
+        try:
+            data = await http_client.get_json(url, params={'key': api_key, 'q': location, 'aqi': 'no'})
+        except aiohttp.ClientResponseError as e:
+            # weatherapi answers 400 for a location it can't find
+            if e.status != 400:
+                raise
+            data = {'error': e.message}
         if 'error' in data:
             await ctx.reply("City not found. Please enter a valid city name.")
         else:
@@ -2006,22 +3308,105 @@ async def weather(ctx, location):
             embed.add_field(name="Wind Speed", value=f"{wind_speed} km/h", inline=True)
             
             await ctx.reply(embed=embed)
-    except Exception as e:
+    except (*HTTP_ERRORS, KeyError, TypeError) as e:
         print(e)
         await ctx.reply("An error occurred while fetching weather data.")
 
+MEME_CACHE_PATH = 'meme_cache.json'
+MEME_REFRESH_INTERVAL = 6 * 60 * 60  # seconds
+MEME_MAX_CHANNELS = 1000
+
+class MemeCatalog:
+    """
+    imgflip's meme templates, kept in memory and in MEME_CACHE_PATH and
+    re-downloaded once they are older than refresh_interval. Each channel
+    draws from its own shuffled bag of templates, so a channel sees every
+    meme once before any repeats. Only the most recently used max_channels
+    bags are kept.
+    """
+
+    url = "https://api.imgflip.com/get_memes"
+
+    def __init__(self, path, refresh_interval, max_channels):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.max_channels = max_channels
+        self.memes = []
+        self.fetched_at = 0.0  # wall clock, so the age survives a restart
+        self.bags = OrderedDict()  # channel_id -> indexes into memes not drawn yet
+        self.inflight = None
+
+    def load_cache(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            self.memes, self.fetched_at = cache['memes'], cache['fetched_at']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save_cache(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': self.fetched_at, 'memes': self.memes}, f)
+        os.replace(temp_path, self.path)
+
+    def stale(self):
+        return not self.memes or time.time() - self.fetched_at > self.refresh_interval
+
+    async def ensure(self):
+        """Refresh the catalog if it's stale. A failed refresh keeps serving the old one, if there is one."""
+        if not self.stale():
+            return
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.fetch())
+        try:
+            await asyncio.shield(self.inflight)
+        except HTTP_ERRORS as e:
+            if not self.memes:
+                raise
+            print(f"Meme refresh failed, keeping the cached list: {e!r}")
+
+    async def fetch(self):
+        try:
+            response = await http_client.get_json(self.url)
+            data = response.get("data") if isinstance(response, dict) and response.get("success") else None
+            if not isinstance(data, dict) or not isinstance(data.get("memes"), list) or not data["memes"]:
+                raise ValueError("imgflip returned no memes")
+            self.memes = data["memes"]
+            self.fetched_at = time.time()
+            # Indexes into the old list mean nothing now
+            self.bags.clear()
+            self.save_cache()
+        finally:
+            self.inflight = None
+
+    def draw(self, channel_id):
+        bag = self.bags.pop(channel_id, None)
+        if not bag:
+            bag = list(range(len(self.memes)))
+            random.shuffle(bag)
+        meme = self.memes[bag.pop()]
+        self.bags[channel_id] = bag
+        if len(self.bags) > self.max_channels:
+            self.bags.popitem(last=False)
+        return meme
+
+meme_catalog = MemeCatalog(MEME_CACHE_PATH, MEME_REFRESH_INTERVAL, MEME_MAX_CHANNELS)
+meme_catalog.load_cache()
+
 @bot.command()
 async def meme(ctx):
     """
     `Get a random meme
     Usage: ,meme`
     """
-    url = "https://api.imgflip.com/get_memes"
-    response = requests.get(url).json()
+    try:
+        await meme_catalog.ensure()
+    except HTTP_ERRORS as e:
+        print(e)
 
-    if response["success"]:
-        memes = response["data"]["memes"]
-        meme = random.choice(memes)  # Pick a random meme
+    if meme_catalog.memes:
+        meme = meme_catalog.draw(ctx.channel.id)
 
         # Create an embed
         embed = discord.Embed(
@@ -2054,11 +3439,38 @@ async def change_activity():
 
     await bot.change_presence(activity=new_activity)
 
+@tasks.loop(seconds=PRICE_TTL)
+async def refresh_prices():
+    try:
+        await price_service.refresh()
+    except HTTP_ERRORS as e:
+        print(f"Price refresh failed: {e!r}")
+
+@tasks.loop(seconds=USER_EXPORT_INTERVAL)
+async def export_users():
+    await db_executor.read(user_exporter.export)
+
+@tasks.loop(seconds=WRITE_BEHIND["flush_interval_ms"] / 1000)
+async def flush_balances():
+    await db_executor.write(balance_buffer.flush)
+
 @bot.event
 async def on_ready():
-    update_user_data()
     print(f'Logged in as {bot.user.name}')
-    change_activity.start()
+    # on_ready fires again after every reconnect
+    if not change_activity.is_running():
+        change_activity.start()
+    if not export_users.is_running():
+        export_users.start()
+    if balance_buffer.enabled and not flush_balances.is_running():
+        flush_balances.start()
+    if PRICE_BACKGROUND_REFRESH and not refresh_prices.is_running():
+        refresh_prices.start()
     bot.start_time = datetime.datetime.utcnow()
-    
-bot.run('MTIzODQ1NjM0Njc0ODI2MDQwMw.G5mtO9.b43NCmwWM7UpcUU3zQGmZ3CzFxokW87iHJhH7c')
+
+try:
+    bot.run('MTIzODQ1NjM0Njc0ODI2MDQwMw.G5mtO9.b43NCmwWM7UpcUU3zQGmZ3CzFxokW87iHJhH7c')
+finally:
+    db_executor.shutdown()
+    # Anything still buffered is written from the main thread once the writer is idle
+    balance_buffer.flush()